@@ -1,15 +1,44 @@
 import json
-from flask import Flask, request, jsonify
+from flask import Flask, g, request, jsonify
 from sqlalchemy.orm import sessionmaker
-from models import Order, ProcessedPurchase, engine, Session
+from models import (
+    Order,
+    ProcessedPurchase,
+    PriceRule,
+    SyncState,
+    VariantInventory,
+    InventoryLevel,
+    StockReservation,
+    engine,
+    Session,
+)
+from sqlalchemy import func, text
 from sqlalchemy.exc import IntegrityError
+from itsdangerous import BadSignature, URLSafeSerializer
 from dotenv import load_dotenv
 import os
 from flask_cors import CORS
+from werkzeug.middleware.proxy_fix import ProxyFix
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 import logging
 import traceback
 import time
+import math
+import hmac
+import hashlib
+import base64
+import threading
+import contextvars
+import uuid
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from breaker import CircuitBreaker, CircuitOpen
+from cache import LoadFailed, RefreshingIndex, SingleFlight, TTLCache
+from ratelimit import KeyedRateLimiter, RateLimited, SharedTokenBucket, TokenBucket
+from pricing import Discount, Money, PriceMismatch, quote_items, shipping_fee as shipping_fee_for
 
 app = Flask(__name__)
 
@@ -21,11 +50,270 @@ SHOPIFY_API_KEY = os.getenv("SHOPIFY_API_KEY")  # This is now the access token
 SHOPIFY_STORE_URL = os.getenv("SHOPIFY_STORE_URL")
 CHIP_IN_API_KEY = os.getenv("CHIP_IN_API_KEY")
 CHIP_IN_BRAND_ID = os.getenv("CHIP_IN_BRAND_ID")
+# Shopify app client secret, used to verify webhook HMAC signatures.
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+# Key for signing checkout discount snapshots (defaults to the Chip In key).
+DISCOUNT_SNAPSHOT_SECRET = os.getenv("DISCOUNT_SNAPSHOT_SECRET") or CHIP_IN_API_KEY or ""
+# Public base URL Shopify delivers webhooks to.
+WEBHOOK_BASE_URL = os.getenv(
+    "WEBHOOK_BASE_URL", "https://chip-in-backend-4531.onrender.com"
+)
+
+# Shopify webhook subscriptions: topic -> receiving path on WEBHOOK_BASE_URL.
+SHOPIFY_WEBHOOKS = {
+    "orders/paid": "/shopify-webhook",
+    "discounts/create": "/shopify-discount-webhook",
+    "discounts/update": "/shopify-discount-webhook",
+    "discounts/delete": "/shopify-discount-webhook",
+    "discounts/redeemcode_added": "/shopify-discount-webhook",
+    "discounts/redeemcode_removed": "/shopify-discount-webhook",
+    "products/create": "/shopify-product-webhook",
+    "products/update": "/shopify-product-webhook",
+    "products/delete": "/shopify-product-webhook",
+    "inventory_levels/update": "/shopify-inventory-webhook",
+}
+
+# Coupon index: seconds a loaded price-rule list is fresh, and how much longer a
+# stale copy may still be served while it reloads in the background. Discount
+# webhooks update the index in place, so with them registered the TTL only
+# bounds how long other workers take to pick up a change from the mirror
+# (0 = never reload).
+COUPON_INDEX_TTL = float(os.getenv("COUPON_INDEX_TTL", 60))
+COUPON_INDEX_STALE_TTL = float(os.getenv("COUPON_INDEX_STALE_TTL", 3600))
+# Price rule mirror: seconds between updated_at_min delta syncs, and between
+# full paginated syncs (the only way deleted rules get dropped).
+PRICE_RULE_SYNC_INTERVAL = float(os.getenv("PRICE_RULE_SYNC_INTERVAL", 300))
+PRICE_RULE_FULL_SYNC_INTERVAL = float(os.getenv("PRICE_RULE_FULL_SYNC_INTERVAL", 86400))
+# How codes are resolved: "index" (local price rule mirror, matched on the rule
+# title) or "lookup" (Shopify's discount_codes/lookup, cached per code).
+COUPON_VALIDATION_MODE = os.getenv("COUPON_VALIDATION_MODE", "index")
+COUPON_LOOKUP_TTL = float(os.getenv("COUPON_LOOKUP_TTL", 300))
+COUPON_LOOKUP_CACHE_SIZE = int(os.getenv("COUPON_LOOKUP_CACHE_SIZE", 2048))
+COUPON_NEGATIVE_TTL = float(os.getenv("COUPON_NEGATIVE_TTL", 600))
+COUPON_NEGATIVE_CACHE_SIZE = int(os.getenv("COUPON_NEGATIVE_CACHE_SIZE", 10000))
+# Retry-After (seconds) sent when a coupon couldn't be checked with Shopify.
+COUPON_RETRY_AFTER = float(os.getenv("COUPON_RETRY_AFTER", 5))
+# /validate-coupon throttle per client IP: sustained checks/second and burst.
+COUPON_THROTTLE_RATE = float(os.getenv("COUPON_THROTTLE_RATE", 0.5))
+COUPON_THROTTLE_BURST = int(os.getenv("COUPON_THROTTLE_BURST", 10))
+# Proxies in front of the app that append to X-Forwarded-For (Render's is
+# one). The client address is taken this many hops from the right; anything
+# further left was sent by the client and can't be trusted.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", 1))
+# Memoized cart quotes: entries kept, and seconds each stays valid.
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", 4096))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", 300))
+# Kept-alive connections per upstream host (Shopify, Chip In); about the most
+# calls one worker makes to either at once.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", 10))
+# Shopify Admin REST budget for this app: sustained requests/second and bucket
+# size (standard plans: 2/s, 40). Every shopify_request call takes a token.
+SHOPIFY_RATE_LIMIT = float(os.getenv("SHOPIFY_RATE_LIMIT", 2))
+SHOPIFY_BURST = int(os.getenv("SHOPIFY_BURST", 40))
+# Fill level (0-1) of Shopify's bucket, as its X-Shopify-Shop-Api-Call-Limit
+# header reports it, above which calls are spaced out a little more the fuller
+# it gets, so it rarely fills up and 429s.
+SHOPIFY_PACING_THRESHOLD = float(os.getenv("SHOPIFY_PACING_THRESHOLD", 0.5))
+# Priority lanes for Shopify calls. Each lane may only take a token while at
+# least its reserve is left in the bucket, so under contention background
+# side effects wait (and are eventually shed) first, then checkout-path reads,
+# while paid-order writes can always use the whole bucket.
+PRIORITY_ORDER_WRITE = "order_write"  # money already taken: creating the paid order
+PRIORITY_CHECKOUT = "checkout"  # reads a customer is waiting on
+PRIORITY_BACKGROUND = "background"  # syncs, webhook refreshes, email consent
+SHOPIFY_LANE_RESERVE = {
+    PRIORITY_ORDER_WRITE: 0,
+    PRIORITY_CHECKOUT: int(os.getenv("SHOPIFY_CHECKOUT_RESERVE", 5)),
+    PRIORITY_BACKGROUND: int(os.getenv("SHOPIFY_BACKGROUND_RESERVE", 15)),
+}
+# Background calls that would wait longer than this (seconds) for their lane
+# are shed with RateLimited instead.
+SHOPIFY_BACKGROUND_MAX_WAIT = float(os.getenv("SHOPIFY_BACKGROUND_MAX_WAIT", 30))
+# SQLite file holding that bucket, shared by every worker on the host, so they
+# pace together instead of each spending the whole budget ("" = per worker).
+SHOPIFY_RATE_LIMIT_DB = os.getenv("SHOPIFY_RATE_LIMIT_DB", "/tmp/shopify_ratelimit.db")
+# Circuit breaker on each upstream (Shopify, Chip In), per worker. Once at
+# least BREAKER_MIN_CALLS calls in the last BREAKER_WINDOW seconds were made
+# and BREAKER_FAILURE_RATE of them errored, got a 5xx or took longer than
+# BREAKER_SLOW_CALL seconds, calls fail fast for BREAKER_OPEN_SECONDS; then
+# BREAKER_PROBES trial calls decide whether it closes again.
+BREAKER_FAILURE_RATE = float(os.getenv("BREAKER_FAILURE_RATE", 0.5))
+BREAKER_MIN_CALLS = int(os.getenv("BREAKER_MIN_CALLS", 10))
+BREAKER_WINDOW = float(os.getenv("BREAKER_WINDOW", 30))
+BREAKER_SLOW_CALL = float(os.getenv("BREAKER_SLOW_CALL", 5))
+BREAKER_OPEN_SECONDS = float(os.getenv("BREAKER_OPEN_SECONDS", 30))
+BREAKER_PROBES = int(os.getenv("BREAKER_PROBES", 3))
+# How check_stock_availability gets stock: "mirror" (local inventory mirror,
+# live "batched" check for anything missing or stale), "batched" (one products
+# call and one inventory_levels call per cart), "concurrent" (per-variant
+# lookups on a thread pool) or "sequential" (per-variant lookups one after
+# another).
+STOCK_CHECK_MODE = os.getenv("STOCK_CHECK_MODE", "mirror")
+# Inventory mirror: seconds between full syncs (needs the read_locations and
+# read_inventory scopes), and how old a level may be -- since its last webhook
+# or the last full sync, whichever is newer -- before checks go live instead.
+INVENTORY_SYNC_INTERVAL = float(os.getenv("INVENTORY_SYNC_INTERVAL", 900))
+INVENTORY_MIRROR_MAX_AGE = float(os.getenv("INVENTORY_MIRROR_MAX_AGE", 1800))
+# Threads for concurrent per-variant lookups, shared by every request.
+STOCK_CHECK_WORKERS = int(os.getenv("STOCK_CHECK_WORKERS", 4))
+# Variant map (variant -> inventory item and policy): seconds before a worker
+# re-reads it from the database to pick up other workers' webhook updates.
+VARIANT_MAP_TTL = float(os.getenv("VARIANT_MAP_TTL", 300))
+# Overall time budget for one stock check, in milliseconds (0 = no limit).
+# Items not resolved in time are assumed in stock.
+STOCK_CHECK_DEADLINE_MS = float(os.getenv("STOCK_CHECK_DEADLINE_MS", 800))
+# Time budget (seconds) for each incoming request, end to end: every upstream
+# call it makes gets what's left as its timeout, and calls with less than
+# UPSTREAM_MIN_CALL_MS left are skipped instead of started. Set per endpoint
+# below, else REQUEST_DEADLINE; 0 = no limit.
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 10))
+REQUEST_DEADLINES = {
+    "create_chip_in_session": float(os.getenv("REQUEST_DEADLINE_CHECKOUT", 10)),
+    "validate_coupon": float(os.getenv("REQUEST_DEADLINE_COUPON", 5)),
+    # Order creation makes several Shopify calls; a timeout only means Chip In
+    # retries the webhook later.
+    "chipin_webhook": float(os.getenv("REQUEST_DEADLINE_CHIPIN_WEBHOOK", 25)),
+}
+UPSTREAM_MIN_CALL_MS = float(os.getenv("UPSTREAM_MIN_CALL_MS", 100))
+# Per-call timeout (seconds) for upstream calls with no deadline around them
+# (background syncs), so a stalled socket can't hang them forever.
+UPSTREAM_TIMEOUT = float(os.getenv("UPSTREAM_TIMEOUT", 15))
+# Timeout (seconds) for the paid-order POST. It isn't idempotent, so it never
+# runs on a request's leftover budget: Shopify could create the order after
+# we'd given up on it.
+SHOPIFY_ORDER_TIMEOUT = float(os.getenv("SHOPIFY_ORDER_TIMEOUT", 30))
+# Live stock results: seconds each variant's availability is reused, and how
+# many variants are kept.
+STOCK_CACHE_TTL = float(os.getenv("STOCK_CACHE_TTL", 3))
+STOCK_CACHE_SIZE = int(os.getenv("STOCK_CACHE_SIZE", 4096))
+# Seconds a checkout holds its stock while the customer pays; unpaid holds
+# stop counting after this.
+STOCK_RESERVATION_TTL = float(os.getenv("STOCK_RESERVATION_TTL", 900))
+# Chip In webhook events / purchase statuses that give a checkout's held stock
+# back.
+RESERVATION_RELEASE_EVENTS = {"purchase.payment_failure", "purchase.cancelled"}
+RESERVATION_RELEASE_STATUSES = {"error", "cancelled", "expired", "blocked"}
+# Most carts one /quote/batch call may price.
+QUOTE_BATCH_MAX_CARTS = int(os.getenv("QUOTE_BATCH_MAX_CARTS", 50))
 
 
 # Use the session from models.py
 session = Session()
 
+# Stock lookups that failed; callers treat the item as sellable (fail open).
+STOCK_UNKNOWN = object()
+
+
+class CouponLookupFailed(Exception):
+    """Shopify couldn't be asked about a coupon. Unlike an unknown code, this
+    must not price the cart as if no coupon had been entered."""
+
+    def __init__(self, message, retry_after=COUPON_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Sent on every call to each upstream.
+SHOPIFY_HEADERS = {
+    "X-Shopify-Access-Token": SHOPIFY_API_KEY or "",
+    "Content-Type": "application/json",
+}
+CHIP_IN_HEADERS = {
+    "Authorization": f"Bearer {CHIP_IN_API_KEY}",
+    "Content-Type": "application/json",
+}
+
+
+def make_http_session(headers, pool_size=HTTP_POOL_SIZE):
+    """A requests.Session that keeps up to ``pool_size`` connections per host
+    alive and sends ``headers`` on every call. Retries stay with the callers
+    (see shopify_request)."""
+    http = requests.Session()
+    http.headers.update(headers)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+# One pooled client per upstream, shared by every request in this worker, so
+# calls reuse warm TCP+TLS connections instead of opening new ones.
+shopify_http = make_http_session(SHOPIFY_HEADERS)
+chip_in_http = make_http_session(CHIP_IN_HEADERS)
+
+
+def make_breaker(name):
+    return CircuitBreaker(
+        name,
+        failure_rate=BREAKER_FAILURE_RATE,
+        min_calls=BREAKER_MIN_CALLS,
+        window=BREAKER_WINDOW,
+        slow_call=BREAKER_SLOW_CALL,
+        open_for=BREAKER_OPEN_SECONDS,
+        probes=BREAKER_PROBES,
+    )
+
+
+def upstream_failed(response):
+    """Responses that count against an upstream's circuit breaker. 4xx
+    (including Shopify's 429s) are our problem, not an outage."""
+    return response.status_code >= 500
+
+
+def cut_short_by_deadline(timeout):
+    """ignore_error for a call sent with ``timeout``: timing out within less
+    than BREAKER_SLOW_CALL only means the caller's deadline ran out, not that
+    the upstream is slow."""
+    return lambda e: isinstance(e, requests.Timeout) and timeout < BREAKER_SLOW_CALL
+
+
+# Stop sending calls to an upstream that's down or crawling, so checkouts fail
+# fast instead of tying up every worker thread on it.
+shopify_breaker = make_breaker("shopify")
+# Paid-order writes get their own, so failing checkout reads can never stop an
+# order being created.
+shopify_order_breaker = make_breaker("shopify orders")
+chip_in_breaker = make_breaker("chip_in")
+
+# time.monotonic() by which upstream calls on the current path must be done,
+# or None for no limit. Set for each incoming request (see
+# start_request_deadline) and tightened around work with a smaller budget
+# (see with_deadline).
+upstream_deadline = contextvars.ContextVar("upstream_deadline", default=None)
+
+# Client-side copy of Shopify's leaky bucket, so concurrent callers (in every
+# worker) queue here instead of all getting 429s.
+if SHOPIFY_RATE_LIMIT_DB:
+    shopify_bucket = SharedTokenBucket(
+        SHOPIFY_RATE_LIMIT_DB,
+        rate=SHOPIFY_RATE_LIMIT,
+        capacity=SHOPIFY_BURST,
+        name="shopify-admin",
+    )
+else:
+    shopify_bucket = TokenBucket(rate=SHOPIFY_RATE_LIMIT, capacity=SHOPIFY_BURST)
+
+# Live availability per variant (str id -> available or None), reused for a
+# few seconds so a hot item in many carts costs one upstream lookup; the
+# single-flight makes concurrent checks for it share the one in progress.
+stock_cache = TTLCache(maxsize=STOCK_CACHE_SIZE, ttl=STOCK_CACHE_TTL)
+stock_flight = SingleFlight()
+
+# Bounded pool for concurrent stock lookups; caps in-flight Shopify calls
+# across all requests in this worker.
+stock_lookup_pool = ThreadPoolExecutor(
+    max_workers=STOCK_CHECK_WORKERS, thread_name_prefix="stock-lookup"
+)
+
+# Signs the discount snapshot carried from checkout to the paid webhook.
+discount_snapshot_signer = URLSafeSerializer(
+    DISCOUNT_SNAPSHOT_SECRET, salt="discount-snapshot"
+)
+
+# Take the client address from the X-Forwarded-For hop our own proxy added,
+# not the spoofable first one (see TRUSTED_PROXY_HOPS).
+if TRUSTED_PROXY_HOPS > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
+
 # Enable CORS for the Shopify domain
 CORS(
     app,
@@ -35,20 +323,139 @@ CORS(
     allow_headers=["Content-Type", "Authorization"],
 )
 
+@app.before_request
+def start_request_deadline():
+    """Give the request its time budget (REQUEST_DEADLINES) as the
+    upstream_deadline every Shopify and Chip In call under it honors."""
+    seconds = REQUEST_DEADLINES.get(request.endpoint, REQUEST_DEADLINE)
+    if seconds > 0:
+        g.deadline_token = upstream_deadline.set(time.monotonic() + seconds)
+
+
+@app.teardown_request
+def clear_request_deadline(exc=None):
+    token = g.pop("deadline_token", None)
+    if token is not None:
+        upstream_deadline.reset(token)
+
+
 # Setup logging to display incoming payloads
 logging.basicConfig(level=logging.INFO)
 logging.info(f"CHIP_IN_BRAND_ID: {CHIP_IN_BRAND_ID}")
 
 
-def shopify_request(method, url, retries=4, **kwargs):
-    """Wrapper around requests that retries on Shopify's 2 req/sec 429s,
-    honoring the Retry-After header. Returns the final response either way."""
+def deadline_remaining():
+    """Seconds left before upstream_deadline, or None if there isn't one."""
+    deadline = upstream_deadline.get()
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+
+def upstream_timeout(what, timeout=None):
+    """Timeout for one upstream call: ``timeout`` (default UPSTREAM_TIMEOUT)
+    cut to what's left of upstream_deadline. Raises TimeoutError instead if
+    there's too little left to start ``what``."""
+    timeout = timeout or UPSTREAM_TIMEOUT
+    remaining = deadline_remaining()
+    if remaining is None:
+        return timeout
+    if remaining < UPSTREAM_MIN_CALL_MS / 1000:
+        raise TimeoutError(f"deadline too close to start {what}")
+    return min(timeout, remaining)
+
+
+def with_deadline(seconds, fn, *args, **kwargs):
+    """Call fn with upstream_deadline set ``seconds`` from now (or kept, if an
+    enclosing deadline is sooner). ``seconds`` <= 0 or None adds no limit."""
+    if not seconds or seconds <= 0:
+        return fn(*args, **kwargs)
+    deadline = time.monotonic() + seconds
+    current = upstream_deadline.get()
+    token = upstream_deadline.set(deadline if current is None else min(current, deadline))
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        upstream_deadline.reset(token)
+
+
+def observe_call_limit(response):
+    """Sync shopify_bucket with the fill level Shopify reports on a response
+    ("X-Shopify-Shop-Api-Call-Limit: 32/40")."""
+    call_limit = response.headers.get("X-Shopify-Shop-Api-Call-Limit")
+    if not call_limit:
+        return
+    try:
+        used, size = (int(part) for part in call_limit.split("/"))
+    except ValueError:
+        logging.warning(f"unreadable X-Shopify-Shop-Api-Call-Limit: {call_limit}")
+        return
+    shopify_bucket.observe(used, size)
+
+
+def shopify_request(
+    method, url, retries=4, block=True, priority=PRIORITY_CHECKOUT, **kwargs
+):
+    """Shopify call on the pooled shopify_http session that retries on
+    Shopify's 2 req/sec 429s, honoring the Retry-After header. Returns the
+    final response either way.
+
+    Every attempt first takes a token from shopify_bucket in ``priority``'s
+    lane: waiting for one by default, or raising RateLimited straight away
+    with ``block=False`` (or, for background calls, when none comes within
+    SHOPIFY_BACKGROUND_MAX_WAIT or the deadline). The bucket follows the usage Shopify
+    reports on each response, and calls other than order writes are paced
+    more slowly as it fills.
+    Each attempt's timeout is what's left of upstream_deadline (see
+    upstream_timeout), and a 429 whose Retry-After would overrun it is
+    returned as is; raises TimeoutError if too little time is left to try.
+    Calls go through shopify_breaker (shopify_order_breaker for order writes):
+    while it's open this raises CircuitOpen before waiting on the bucket."""
+    breaker = shopify_order_breaker if priority == PRIORITY_ORDER_WRITE else shopify_breaker
     resp = None
     for attempt in range(retries):
-        resp = requests.request(method, url, **kwargs)
+        remaining = deadline_remaining()
+        if remaining is not None and remaining < UPSTREAM_MIN_CALL_MS / 1000:
+            raise TimeoutError(f"deadline too close to start {method} {url}")
+        breaker.check()
+        wait = remaining
+        if priority == PRIORITY_BACKGROUND:
+            wait = min(remaining or math.inf, SHOPIFY_BACKGROUND_MAX_WAIT)
+        if not shopify_bucket.acquire(
+            block=block, timeout=wait, reserve=SHOPIFY_LANE_RESERVE[priority]
+        ):
+            if not block or priority == PRIORITY_BACKGROUND:
+                raise RateLimited(
+                    f"Shopify rate limit reached, shedding {priority} {method} {url}"
+                )
+            raise TimeoutError(f"deadline passed waiting to send {method} {url}")
+        # Ease off smoothly as the bucket nears full (skipped for order writes,
+        # callers that won't wait, or when it would overrun their deadline).
+        pace = 0
+        if block and priority != PRIORITY_ORDER_WRITE:
+            pace = shopify_bucket.pacing_delay(SHOPIFY_PACING_THRESHOLD)
+        if pace and (remaining is None or pace < deadline_remaining()):
+            time.sleep(pace)
+        timeout = kwargs["timeout"] = upstream_timeout(f"{method} {url}", kwargs.get("timeout"))
+        resp = breaker.call(
+            shopify_http.request,
+            method,
+            url,
+            is_failure=upstream_failed,
+            ignore_error=cut_short_by_deadline(timeout),
+            **kwargs,
+        )
+        observe_call_limit(resp)
         if resp.status_code != 429:
             return resp
         retry_after = float(resp.headers.get("Retry-After", 1))
+        remaining = deadline_remaining()
+        if remaining is not None and retry_after >= remaining:
+            logging.warning(
+                f"Shopify 429 on {method} {url}; Retry-After {retry_after}s "
+                "is past the deadline, giving up"
+            )
+            return resp
         logging.warning(
             f"Shopify 429 on {method} {url}; retry {attempt + 1}/{retries} "
             f"after {retry_after}s"
@@ -57,64 +464,324 @@ def shopify_request(method, url, retries=4, **kwargs):
     return resp
 
 
+def _next_page_url(response):
+    """Shopify cursor pagination: the next page is the Link rel="next" URL."""
+    return response.links.get("next", {}).get("url")
+
+
+def _store_price_rule(db, rule):
+    db.merge(
+        PriceRule(
+            id=str(rule["id"]),
+            title=rule.get("title"),
+            value=rule.get("value"),
+            value_type=rule.get("value_type"),
+            updated_at=rule.get("updated_at"),
+            data=json.dumps(rule),
+        )
+    )
+
+
+def sync_price_rules(full=False):
+    """Mirror Shopify price rules into the local price_rules table.
+
+    The first run (or ``full=True``) follows Link-header pagination over every
+    rule and drops local rows Shopify no longer has. Later runs only ask for
+    rules with ``updated_at_min`` >= the newest one already mirrored.
+    Returns the number of rules received."""
+    db = Session()
+    try:
+        state = db.get(SyncState, "price_rules") or SyncState(name="price_rules")
+        full = full or not state.cursor
+
+        params = {"limit": 250}
+        if not full:
+            params["updated_at_min"] = state.cursor
+        url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/price_rules.json?{urlencode(params)}"
+
+        newest = state.cursor or ""
+        seen_ids = set()
+        while url:
+            response = shopify_request("GET", url, priority=PRIORITY_BACKGROUND)
+            if response.status_code != 200:
+                raise RuntimeError(
+                    f"price_rules sync returned {response.status_code}: {response.text}"
+                )
+            for rule in response.json().get("price_rules", []):
+                _store_price_rule(db, rule)
+                seen_ids.add(str(rule["id"]))
+                newest = max(newest, rule.get("updated_at") or "")
+            url = _next_page_url(response)
+
+        now = time.time()
+        if full:
+            # Deltas can't see deletions; a full pass is where they get dropped.
+            db.query(PriceRule).filter(~PriceRule.id.in_(seen_ids)).delete(
+                synchronize_session=False
+            )
+            state.last_full_sync_at = now
+        state.cursor = newest or None
+        state.last_synced_at = now
+        db.merge(state)
+        db.commit()
+        logging.info(
+            f"price rule sync ({'full' if full else 'delta'}): {len(seen_ids)} rule(s)"
+        )
+        return len(seen_ids)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def sync_price_rules_if_due():
+    """Run the price rule sync when the shared sync state says it's time."""
+    db = Session()
+    try:
+        state = db.get(SyncState, "price_rules")
+        last_synced_at = state.last_synced_at if state else None
+        last_full_sync_at = state.last_full_sync_at if state else None
+    finally:
+        db.close()
+
+    now = time.time()
+    if not last_full_sync_at or now - last_full_sync_at >= PRICE_RULE_FULL_SYNC_INTERVAL:
+        sync_price_rules(full=True)
+    elif not last_synced_at or now - last_synced_at >= PRICE_RULE_SYNC_INTERVAL:
+        sync_price_rules()
+
+
+def load_price_rule_index():
+    """Build the code (rule title) -> rule map from the local mirror, syncing
+    the mirror from Shopify first when it's due."""
+    try:
+        sync_price_rules_if_due()
+        synced = True
+    except Exception as e:
+        logging.error(f"price rule sync failed, serving local mirror: {e}")
+        synced = False
+
+    db = Session()
+    try:
+        rows = db.query(PriceRule.title, PriceRule.data).all()
+    finally:
+        db.close()
+    if not rows and not synced:
+        raise RuntimeError("price rule mirror is empty and sync failed")
+    return {title: json.loads(data) for title, data in rows}
+
+
+# Memoized cart quotes: canonical cart hash -> (Discount or None, Quote).
+quote_cache = TTLCache(maxsize=QUOTE_CACHE_SIZE, ttl=QUOTE_CACHE_TTL)
+
+
+# Price rules change a few times a day but are read on every coupon check,
+# checkout and paid webhook. Share one code -> rule index per worker, built from
+# the local mirror; upstream syncs happen in the background reload only.
+coupon_index = RefreshingIndex(
+    load_price_rule_index,
+    ttl=COUPON_INDEX_TTL,
+    stale_ttl=COUPON_INDEX_STALE_TTL,
+    name="coupon index",
+    # Memoized quotes embed the old discount; drop them when rules change.
+    on_change=quote_cache.clear,
+)
+
+
+# Per-code results for "lookup" mode: code -> price rule, plus codes Shopify
+# confirmed don't exist.
+coupon_lookup_cache = TTLCache(maxsize=COUPON_LOOKUP_CACHE_SIZE, ttl=COUPON_LOOKUP_TTL)
+unknown_coupon_cache = TTLCache(
+    maxsize=COUPON_NEGATIVE_CACHE_SIZE, ttl=COUPON_NEGATIVE_TTL
+)
+
+# Per-client throttle for /validate-coupon, so code guessing gets a cheap 429
+# instead of competing with paid-order creation for the Shopify budget.
+coupon_throttle = KeyedRateLimiter(
+    rate=COUPON_THROTTLE_RATE, capacity=COUPON_THROTTLE_BURST
+)
+
+
+def client_ip():
+    # ProxyFix has already replaced remote_addr with the hop our proxy saw.
+    return request.remote_addr
+
+
+def lookup_price_rule(coupon_code):
+    """Resolve a single code with discount_codes/lookup, then fetch only its
+    price rule. Returns the rule, or None if Shopify doesn't know the code."""
+    # Shopify answers with a 303 to the discount code; requests follows it.
+    response = shopify_request(
+        "GET",
+        f"{SHOPIFY_STORE_URL}/admin/api/2024-10/discount_codes/lookup.json?"
+        f"{urlencode({'code': coupon_code})}",
+    )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"discount code lookup returned {response.status_code}: {response.text}"
+        )
+    price_rule_id = response.json().get("discount_code", {}).get("price_rule_id")
+    if not price_rule_id:
+        return None
+
+    response = shopify_request(
+        "GET",
+        f"{SHOPIFY_STORE_URL}/admin/api/2024-10/price_rules/{price_rule_id}.json",
+    )
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"price rule {price_rule_id} returned {response.status_code}: {response.text}"
+        )
+    return response.json().get("price_rule")
+
+
+def find_price_rule(coupon_code):
+    """The price rule for ``coupon_code``, or None if Shopify doesn't know it.
+    Raises CouponLookupFailed when Shopify can't be reached ("lookup" mode) or
+    the price rule index can't be loaded (within the request's deadline)."""
+    if COUPON_VALIDATION_MODE != "lookup":
+        try:
+            # A cold index reload (a full price rule sync) keeps going in the
+            # background; this request only waits for what's left of its budget.
+            return coupon_index.get(coupon_code, timeout=deadline_remaining())
+        except (TimeoutError, LoadFailed) as e:
+            # An index that was never loaded is not one without this code.
+            raise CouponLookupFailed(f"couldn't check coupon {coupon_code!r}: {e}") from e
+
+    rule = coupon_lookup_cache.get(coupon_code)
+    if rule is None:
+        # Codes Shopify already said it doesn't know (guessing bots) are
+        # answered from memory instead of spending the rate budget again.
+        if unknown_coupon_cache.get(coupon_code):
+            return None
+        try:
+            rule = lookup_price_rule(coupon_code)
+        except Exception as e:
+            logging.error(f"Coupon lookup failed for {coupon_code!r}: {e}")
+            raise CouponLookupFailed(
+                f"couldn't check coupon {coupon_code!r}: {e}",
+                getattr(e, "retry_after", COUPON_RETRY_AFTER),
+            ) from e
+        if rule:
+            coupon_lookup_cache.set(coupon_code, rule)
+        else:
+            unknown_coupon_cache.set(coupon_code, True)
+    return rule
+
+
 # Function to check if the coupon is valid
 def validate_shopify_coupon(coupon_code):
-    url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/price_rules.json"
+    rule = find_price_rule(coupon_code)
+    if rule:
+        return (
+            True,
+            rule["value"],
+            rule["value_type"],
+        )  # Return the discount value
 
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
+    return False, None, None  # Coupon is invalid
 
-    # Send a request to Shopify to get all discount codes (price rules)
-    response = requests.get(url, headers=headers)
-    logging.info(f"price rule response.content: {response.content}")
-    if response.status_code == 200:
-        price_rules = response.json().get("price_rules", [])
-        logging.info(f"price rule: {price_rules}")
-        for rule in price_rules:
-            # Check if the coupon code matches a valid price rule
-            if coupon_code == rule["title"]:
-                return (
-                    True,
-                    rule["value"],
-                    rule["value_type"],
-                )  # Return the discount value
 
-    return False, None, None  # Coupon is invalid
+# Item fields that affect a quote; anything else (names, images) is ignored
+# when hashing a cart.
+QUOTE_ITEM_FIELDS = (
+    "variant_id",
+    "quantity",
+    "price",
+    "original_price",
+    "original_line_price",
+    "total_discount",
+    "final_line_price",
+    "requires_shipping",
+)
 
 
-def calculate_price_based_on_discount(
-    price,
-    discount_value,
-    value_type,
-    override=0,
-):
-    logging.info(f"price {price}, dicsount {discount_value}")
+def cart_quote_key(items, coupon_code, country, province, basis, validate):
+    cart = [{field: item.get(field) for field in QUOTE_ITEM_FIELDS} for item in items]
+    raw = json.dumps(
+        [cart, coupon_code, country, province, basis, validate],
+        sort_keys=True,
+        default=str,
+    )
+    return hashlib.sha256(raw.encode()).hexdigest()
 
-    if value_type == "percentage" and override:
-        discount_amount = price * discount_value / 100
-        return price + discount_amount  # discount amount is in negative
 
-    elif value_type == "percentage":
-        discount_amount = price * discount_value / 100
-        return price + discount_amount  # discount amount is in negative
+def quote_cart(items, coupon_code, country=None, province=None, basis="final", validate=False):
+    """Validate the coupon and price the cart, memoized on a canonical hash
+    of items, coupon and destination. Returns (Discount or None, Quote).
+    PriceMismatch propagates and is never cached."""
+    key = cart_quote_key(items, coupon_code, country, province, basis, validate)
+    cached = quote_cache.get(key)
+    if cached is not None:
+        return cached
 
-    elif value_type == "fixed_amount":
-        discount_value = discount_value * 100
+    discount = None
+    # Only look the coupon up when one was actually entered.
+    if coupon_code:
+        coupon_is_valid, discount_value, value_type = validate_shopify_coupon(
+            coupon_code
+        )
+        if coupon_is_valid:
+            discount = Discount.from_rule(coupon_code, discount_value, value_type)
 
-        if price <= -discount_value:
-            return 0.1
-        else:
-            return price + discount_value
+    quote = quote_items(
+        items, discount, country, province, basis=basis, validate=validate
+    )
+    quote_cache.set(key, (discount, quote))
+    return discount, quote
+
+
+def sign_discount_snapshot(code, value, value_type, discount, capped):
+    """Compact signed record of the coupon as charged at checkout.
+    ``discount`` is the total applied, in sen."""
+    return discount_snapshot_signer.dumps(
+        {
+            "c": code,
+            "v": value,
+            "t": value_type,
+            "d": int(discount),
+            "x": int(capped),
+        }
+    )
+
+
+def load_discount_snapshot(token):
+    """Verify and expand a token from sign_discount_snapshot(); None if the
+    signature doesn't check out."""
+    try:
+        raw = discount_snapshot_signer.loads(token)
+    except BadSignature:
+        logging.error(f"Rejecting discount snapshot with a bad signature: {token!r}")
+        return None
+    return {
+        "code": raw["c"],
+        "value": raw["v"],
+        "value_type": raw["t"],
+        "discount": raw["d"],
+        "capped": bool(raw["x"]),
+    }
 
-    else:
-        return 0
+
+def discount_codes_from_snapshot(snapshot):
+    # Always the exact amount the customer was given. Shopify would recompute
+    # a percentage on price x qty, while checkout applied it per line to
+    # final_line_price (after automatic discounts), rounding each line and
+    # capping the total, so the totals could drift apart.
+    amount = Money(snapshot["discount"]).ringgit()
+    return [{"code": snapshot["code"], "amount": amount, "type": "fixed_amount"}]
 
 
 @app.route("/create-chip-in-session", methods=["POST"])
 def create_chip_in_session():
     try:
+        # No point pricing and reserving stock for a checkout Chip In can't take.
+        chip_in_breaker.check()
+
         # Step 1: Get the JSON data sent from the frontend
         data = request.get_json()
 
@@ -183,90 +850,35 @@ def create_chip_in_session():
         # Step 3.1: Check if all required fields are present
         
 
-        # Step 3.2 Validate shopify coupon
+        # Step 3.2 Validate shopify coupon and price the cart
         coupon_code = data.get("coupon_code", None)
 
-        coupon_is_valid = False
-        discount_value = 0
-        value_type = None
-        # Only hit Shopify's price_rules API when a coupon was actually entered.
-        if coupon_code:
-            coupon_is_valid, discount_value, value_type = validate_shopify_coupon(
-                coupon_code
+        try:
+            discount, quote = quote_cart(
+                items, coupon_code, country, province, validate=True
             )
-        logging.info(
-            f"coup info: code {coupon_code}, valid {coupon_is_valid}, discount {discount_value}, value_type {value_type}"
-        )
+        except PriceMismatch as e:
+            return jsonify({"error": str(e)}), 400
+        logging.info(f"coup info: code {coupon_code}, discount {discount}")
 
         # Step 4: Prepare the payload for Chip In API
         chip_in_url = "https://gate.chip-in.asia/api/v1/purchases/"
 
-        headers = {
-            "Authorization": f"Bearer {CHIP_IN_API_KEY}",
-            "Content-Type": "application/json",
-        }
-
         # Prepare the success_redirect URL with dynamic data (e.g., order_id)
         success_redirect_url = f"{SHOPIFY_STORE_URL}/pages/thank-you-page?order_id={shopify_order_id}&status=paid"
 
-        requires_shipping = any(item.get("requires_shipping", True) for item in items)
-
-        if requires_shipping != True:
-            shipping_fee = 0
-        elif country == "MY":
-            if province in ["MY-12", "MY-13", "MY-15"]:
-                shipping_fee = 900
-            else:
-                shipping_fee = 700
-        else:
-            shipping_fee = {
-                "SG": 4000,
-                "BN": 7000,
-                "ID": 11000
-            }.get(country, 0)
-
-        discount_balance = 2000  # 2000 sen = 20 ringgit
-
-        total_override = 0
-
-        for item in items:
-            # validate original line price = quantity x produce price 
-            
-            # validate: original_price * quantity = original_line_price
-            # recheck this
-            if round(float(item["original_price"]), 2) != round(float(item["original_price"]) * float(item["quantity"]), 2):
-                return jsonify({"error": "Item price mismatch this"}), 400
-
-            # validate: final_line_price = original_line_price - total_discount
-            if round(float(item["final_line_price"]), 2) != round(float(item["original_line_price"]) - float(item["total_discount"]), 2):
-                return jsonify({"error": "Item price mismatch that"}), 400
-            
-            # price = float(item["price"]) * float(item["quantity"])
-            price = float(item["final_line_price"])
-
-            if coupon_is_valid:
-                calculated_item_price = calculate_price_based_on_discount(
-                    price,
-                    float(discount_value),
-                    value_type,
-                )
-
-                if price - calculated_item_price > discount_balance:
-                    calculated_item_price = price - discount_balance
-                    coupon_is_valid = False
-
-                discount_balance -= price - calculated_item_price
-
-            else:
-                calculated_item_price = price
-
-            total_override += calculated_item_price
-
-        total_override += shipping_fee  # shipping fee
+        total_override = quote.total.sen
 
         # Block checkout before payment if any item is out of stock, so the
-        # customer never pays for something the webhook can't fulfill.
-        out_of_stock = check_stock_availability(items)
+        # customer never pays for something the webhook can't fulfill. What
+        # passes is held for this checkout until it's paid or abandoned.
+        snapshot = get_stock_snapshot(items)
+        stock_check = stock_check_summary(items, snapshot)
+        try:
+            reservation_id, out_of_stock = reserve_stock(items, snapshot)
+        except Exception as e:
+            logging.error(f"stock reservation failed, checking without it: {e}")
+            reservation_id, out_of_stock = None, out_of_stock_items(items, snapshot)
         if out_of_stock:
             logging.warning(f"Blocking checkout, out of stock: {out_of_stock}")
             return (
@@ -276,6 +888,7 @@ def create_chip_in_session():
                         "message": "Sorry, the following item(s) are out of stock: "
                         + ", ".join(out_of_stock),
                         "items": out_of_stock,
+                        "stock_check": stock_check,
                     }
                 ),
                 409,
@@ -313,7 +926,19 @@ def create_chip_in_session():
                 "total_override": total_override,
                 "currency": "MYR",
                 "metadata": {
-                    "shopify_payload": data  # store all your custom fields here
+                    "shopify_payload": data,  # store all your custom fields here
+                    # What the customer was actually charged for the coupon, so
+                    # the paid webhook doesn't re-validate it against Shopify.
+                    "discount_snapshot": sign_discount_snapshot(
+                        coupon_code,
+                        str(discount.value),
+                        discount.value_type,
+                        quote.discount.sen,
+                        quote.cap_applied,
+                    )
+                    if discount
+                    else None,
+                    "stock_reservation": reservation_id,
                 }
             },
             "success_redirect": success_redirect_url,  # Add the success_redirect URL here
@@ -325,17 +950,38 @@ def create_chip_in_session():
         logging.info(f"Payload sent to Chip In API: {payload}")
 
         # Step 5: Send the request to Chip In API
-        response = requests.post(chip_in_url, json=payload, headers=headers)
-        logging.info(f"POST chip in purchase: {response.content}")
-        response_data = response.json()
+        try:
+            timeout = upstream_timeout("Chip In purchase")
+            response = chip_in_breaker.call(
+                chip_in_http.post,
+                chip_in_url,
+                json=payload,
+                timeout=timeout,
+                is_failure=upstream_failed,
+                ignore_error=cut_short_by_deadline(timeout),
+            )
+            logging.info(f"POST chip in purchase: {response.content}")
+            response_data = response.json()
+        except Exception:
+            finish_reservation(reservation_id, "released")
+            raise
 
         # Log the response from Chip In API for debugging
         logging.info(f"Chip In API Response: {response_data}")
 
         # Check if the response status is successful
         if response.status_code == 201 and response_data.get("checkout_url"):
-            return jsonify({"checkout_url": response_data["checkout_url"]}), 201
+            return (
+                jsonify(
+                    {
+                        "checkout_url": response_data["checkout_url"],
+                        "stock_check": stock_check,
+                    }
+                ),
+                201,
+            )
         else:
+            finish_reservation(reservation_id, "released")
             return (
                 jsonify(
                     {
@@ -345,6 +991,43 @@ def create_chip_in_session():
                 ),
                 400,
             )
+    except CouponLookupFailed as e:
+        # Charging full price would silently drop the customer's coupon.
+        return (
+            jsonify(
+                {
+                    "error": "coupon_unavailable",
+                    "message": "We couldn't check your coupon right now, please try again shortly",
+                    "retry_after": math.ceil(e.retry_after),
+                }
+            ),
+            503,
+            {"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except CircuitOpen as e:
+        logging.warning(f"Checkout refused, {e}")
+        return (
+            jsonify(
+                {
+                    "error": "upstream_unavailable",
+                    "message": "Payments are temporarily unavailable, please try again shortly",
+                    "retry_after": math.ceil(e.retry_after),
+                }
+            ),
+            503,
+            {"Retry-After": str(math.ceil(e.retry_after))},
+        )
+    except (TimeoutError, requests.Timeout) as e:
+        logging.error(f"Checkout ran out of time: {e}")
+        return (
+            jsonify(
+                {
+                    "error": "timeout",
+                    "message": "Checkout is taking too long, please try again",
+                }
+            ),
+            504,
+        )
     except Exception as e:
         logging.error(f"Error processing payment: {traceback.format_exc()}")
         return jsonify({"error": str(e)}), 500
@@ -391,6 +1074,7 @@ def chipin_webhook():
 
             # Create Shopify order
             shopify_order_response = create_shopify_order(
+                claim_id=chip_in_id,
                 name=data["client"]["full_name"],
                 email=data["client"]["email"],
                 phone=data["client"]["phone"],
@@ -405,6 +1089,7 @@ def chipin_webhook():
                 items=data['purchase']['metadata']['shopify_payload']['items'],
                 email_marketing_consent_state=data["client"]["state"],
                 coupon_code=data['purchase']['metadata']['shopify_payload'].get('coupon_code'),
+                discount_snapshot=data['purchase']['metadata'].get('discount_snapshot'),
                 metafields=extra,
             )
 
@@ -412,6 +1097,14 @@ def chipin_webhook():
                 logging.info(
                     f"Shopify order created successfully: {shopify_order_response}"
                 )
+                # Shopify's own stock now reflects the order.
+                try:
+                    finish_reservation(
+                        data['purchase']['metadata'].get('stock_reservation'), "consumed"
+                    )
+                except Exception as e:
+                    # The hold just expires; the order must still be marked done.
+                    logging.error(f"Couldn't consume stock reservation for {chip_in_id}: {e}")
                 # Finalize the claim so future deliveries are skipped.
                 claim = session.get(ProcessedPurchase, chip_in_id)
                 if claim:
@@ -423,12 +1116,21 @@ def chipin_webhook():
                 return jsonify({"status": "success"}), 200
             else:
                 logging.error("Failed to create Shopify order")
-                # Release the claim so Chip In's retry can try again.
-                session.query(ProcessedPurchase).filter_by(
-                    chip_in_id=chip_in_id
-                ).delete()
-                session.commit()
+                # Release the claim so Chip In's retry can try again (unless the
+                # order POST went out, see release_purchase_claim).
+                release_purchase_claim(chip_in_id)
                 return jsonify({"error": "Failed to create Shopify order"}), 400
+        elif (
+            data.get("event_type") in RESERVATION_RELEASE_EVENTS
+            or data.get("status") in RESERVATION_RELEASE_STATUSES
+        ):
+            logging.info(
+                f"Chip In purchase {data.get('id')} {data.get('event_type') or data['status']}; "
+                "releasing its stock"
+            )
+            metadata = (data.get("purchase") or {}).get("metadata") or {}
+            finish_reservation(metadata.get("stock_reservation"), "released")
+            return jsonify({"status": "released"}), 200
         else:
             logging.warning(f"Chip In order status not paid: {data['status']}")
             return jsonify({"status": "ignored"}), 200
@@ -440,66 +1142,274 @@ def chipin_webhook():
             claimed_id = data.get("id") if isinstance(data, dict) else None
             if claimed_id:
                 session.rollback()
-                session.query(ProcessedPurchase).filter_by(
-                    chip_in_id=claimed_id, status="processing"
-                ).delete()
-                session.commit()
+                release_purchase_claim(claimed_id)
         except Exception as cleanup_err:
             logging.error(f"Claim cleanup failed: {cleanup_err}")
             session.rollback()
         return jsonify({"error": str(e)}), 500
 
 
+def mark_purchase_claim(chip_in_id, status):
+    """Move a ProcessedPurchase claim to ``status`` (committed straight away)."""
+    if not chip_in_id:
+        return
+    session.query(ProcessedPurchase).filter_by(chip_in_id=chip_in_id).update(
+        {"status": status}, synchronize_session="fetch"
+    )
+    session.commit()
+
+
+def release_purchase_claim(chip_in_id):
+    """Drop a claim so Chip In's retry can create the order. Only "processing"
+    claims go: once the order POST is out ("ordering"), Shopify may have
+    created the order even though we saw an error, and a retry would make a
+    second one. Those are left for staff to reconcile."""
+    released = (
+        session.query(ProcessedPurchase)
+        .filter_by(chip_in_id=chip_in_id, status="processing")
+        .delete()
+    )
+    session.commit()
+    if not released:
+        logging.error(
+            f"Keeping claim for Chip In purchase {chip_in_id}: its Shopify order "
+            "may already exist, check Shopify before creating it by hand"
+        )
+
+
+def order_never_sent(e):
+    """True if ``e`` from post_shopify_order means the POST never reached
+    Shopify: refused by the breaker or bucket, or no connection was made."""
+    if isinstance(e, (CircuitOpen, RateLimited, TimeoutError, requests.ConnectTimeout)):
+        return True
+    if isinstance(e, requests.ConnectionError):
+        # Refused or unresolvable. Other ConnectionErrors (reset, closed
+        # mid-response) can come after Shopify got the order.
+        reason = getattr(e.args[0], "reason", None) if e.args else None
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+def post_shopify_order(order_url, order_data, claim_id=None):
+    """POST orders.json with its own SHOPIFY_ORDER_TIMEOUT. The call isn't
+    idempotent, so it doesn't inherit the request's upstream_deadline.
+
+    The webhook's claim is moved to "ordering" first: from then on the order
+    may exist in Shopify, so it must survive any error (see
+    release_purchase_claim). If the POST provably never went out, it's moved
+    back to "processing" so Chip In's retry can create the order."""
+    mark_purchase_claim(claim_id, "ordering")
+    token = upstream_deadline.set(None)
+    try:
+        return shopify_request(
+            "POST",
+            order_url,
+            json=order_data,
+            timeout=SHOPIFY_ORDER_TIMEOUT,
+            priority=PRIORITY_ORDER_WRITE,
+        )
+    except Exception as e:
+        if order_never_sent(e):
+            logging.warning(f"Shopify order POST never sent ({e}); claim can be retried")
+            mark_purchase_claim(claim_id, "processing")
+        raise
+    finally:
+        upstream_deadline.reset(token)
+
+
 def check_existing_webhook():
-    # Check if the webhook already exists to avoid duplicating registration
+    """Return the topics already subscribed to the address we'd register."""
+    # Check which webhooks already exist to avoid duplicating registration
     shopify_webhook_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/webhooks.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
-
-    response = requests.get(shopify_webhook_url, headers=headers)
+    registered = set()
+    response = shopify_request("GET", shopify_webhook_url, priority=PRIORITY_BACKGROUND)
     logging.info(f"GET shopify webhook: {response.content}")
     if response.status_code == 200:
         existing_webhooks = response.json().get("webhooks", [])
         for webhook in existing_webhooks:
-            if (
-                webhook["address"]
-                == "https://chip-in-backend-4531.onrender.com/shopify-webhook"
-                and webhook["topic"] == "orders/paid"
-            ):
-                logging.info("Shopify webhook already registered.")
-                return True
-    return False
+            path = SHOPIFY_WEBHOOKS.get(webhook["topic"])
+            if path and webhook["address"] == f"{WEBHOOK_BASE_URL}{path}":
+                registered.add(webhook["topic"])
+    return registered
 
 
 def register_shopify_webhook():
-    if check_existing_webhook():
-        return  # Skip registration if the webhook already exists
+    registered = check_existing_webhook()
 
     shopify_webhook_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/webhooks.json"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
-
-    webhook_data = {
-        "webhook": {
-            "topic": "orders/paid",
-            "address": "https://chip-in-backend-4531.onrender.com/shopify-webhook",  # Update with your actual server URL
-            "format": "json",
+    for topic, path in SHOPIFY_WEBHOOKS.items():
+        if topic in registered:
+            logging.info(f"Shopify webhook {topic} already registered.")
+            continue  # Skip registration if the webhook already exists
+
+        webhook_data = {
+            "webhook": {
+                "topic": topic,
+                "address": f"{WEBHOOK_BASE_URL}{path}",
+                "format": "json",
+            }
         }
-    }
 
-    response = requests.post(shopify_webhook_url, json=webhook_data, headers=headers)
-    logging.info(f"POST shopify webhook: {response.content}")
+        response = shopify_request(
+            "POST", shopify_webhook_url, json=webhook_data, priority=PRIORITY_BACKGROUND
+        )
+        logging.info(f"POST shopify webhook {topic}: {response.content}")
 
-    if response.status_code == 201:
-        logging.info("Webhook registered successfully")
-    else:
-        logging.error(
-            f"Failed to register webhook: {response.status_code}, {response.text}"
+        if response.status_code == 201:
+            logging.info(f"Webhook {topic} registered successfully")
+        else:
+            logging.error(
+                f"Failed to register webhook {topic}: {response.status_code}, {response.text}"
+            )
+
+
+def verify_shopify_webhook():
+    """True if X-Shopify-Hmac-Sha256 matches the raw body signed with the app
+    secret."""
+    if not SHOPIFY_WEBHOOK_SECRET:
+        logging.error("SHOPIFY_WEBHOOK_SECRET is not set; rejecting webhook")
+        return False
+    digest = hmac.new(
+        SHOPIFY_WEBHOOK_SECRET.encode(), request.get_data(), hashlib.sha256
+    ).digest()
+    return hmac.compare_digest(
+        base64.b64encode(digest).decode(),
+        request.headers.get("X-Shopify-Hmac-Sha256", ""),
+    )
+
+
+def forget_price_rule(price_rule_id):
+    """Drop a price rule from the mirror and every in-memory coupon cache."""
+    price_rule_id = str(price_rule_id)
+    db = Session()
+    try:
+        db.query(PriceRule).filter_by(id=price_rule_id).delete()
+        db.commit()
+    finally:
+        db.close()
+
+    def same_rule(_code, rule):
+        return str(rule.get("id")) == price_rule_id
+
+    coupon_index.evict_where(same_rule)
+    coupon_lookup_cache.evict_where(same_rule)
+    quote_cache.clear()
+
+
+def refresh_price_rule(price_rule_id):
+    """Re-fetch one price rule and update the mirror and coupon caches in place."""
+    response = shopify_request(
+        "GET",
+        f"{SHOPIFY_STORE_URL}/admin/api/2024-10/price_rules/{price_rule_id}.json",
+        priority=PRIORITY_BACKGROUND,
+    )
+    if response.status_code == 404:
+        forget_price_rule(price_rule_id)
+        return
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"price rule {price_rule_id} returned {response.status_code}: {response.text}"
         )
+    rule = response.json()["price_rule"]
+
+    db = Session()
+    try:
+        _store_price_rule(db, rule)
+        db.commit()
+    finally:
+        db.close()
+
+    # The title (our code) may have changed, so drop the old entry first.
+    def same_rule(_code, cached):
+        return str(cached.get("id")) == str(rule["id"])
+
+    coupon_index.evict_where(same_rule)
+    coupon_index.put(rule["title"], rule)
+    coupon_lookup_cache.evict_where(same_rule)
+    unknown_coupon_cache.pop(rule["title"])
+    quote_cache.clear()
+
+
+@app.route("/shopify-discount-webhook", methods=["POST"])
+def shopify_discount_webhook():
+    """Keep the coupon caches current from discounts/* webhooks, so validation
+    can run from memory and still see merchant edits within seconds."""
+    if not verify_shopify_webhook():
+        return jsonify({"error": "Invalid webhook signature"}), 401
+
+    try:
+        topic = request.headers.get("X-Shopify-Topic")
+        data = request.get_json()
+        logging.info(f"Received Shopify discount webhook {topic}: {data}")
+
+        # Code discounts are DiscountCodeNodes whose id is the price rule id;
+        # automatic discounts never go through coupon validation.
+        gid = data.get("admin_graphql_api_id", "")
+        if "/DiscountCodeNode/" not in gid:
+            return jsonify({"status": "ignored"}), 200
+        price_rule_id = gid.rsplit("/", 1)[-1]
+
+        if topic == "discounts/delete":
+            forget_price_rule(price_rule_id)
+        elif topic == "discounts/redeemcode_removed":
+            code = data.get("redeem_code", {}).get("code")
+            if code:
+                coupon_lookup_cache.pop(code)
+                quote_cache.clear()
+        elif topic == "discounts/redeemcode_added":
+            code = data.get("redeem_code", {}).get("code")
+            if code:
+                unknown_coupon_cache.pop(code)
+        else:
+            refresh_price_rule(price_rule_id)
+
+        return jsonify({"status": "success"}), 200
+    except Exception as e:
+        # A non-2xx makes Shopify redeliver, which is what we want here.
+        logging.error(f"Error processing Shopify discount webhook: {traceback.format_exc()}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/shopify-product-webhook", methods=["POST"])
+def shopify_product_webhook():
+    """Keep the variant map current from products/* webhooks, so a variant that
+    starts or stops tracking inventory is checked correctly straight away."""
+    if not verify_shopify_webhook():
+        return jsonify({"error": "Invalid webhook signature"}), 401
+
+    try:
+        topic = request.headers.get("X-Shopify-Topic")
+        data = request.get_json()
+        logging.info(f"Received Shopify product webhook {topic} for product {data.get('id')}")
+
+        if topic == "products/delete":
+            forget_product_variants(data["id"])
+        else:
+            remember_variants(data.get("variants", []), product_id=data["id"])
+
+        return jsonify({"status": "success"}), 200
+    except Exception as e:
+        # A non-2xx makes Shopify redeliver, which is what we want here.
+        logging.error(f"Error processing Shopify product webhook: {traceback.format_exc()}")
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/shopify-inventory-webhook", methods=["POST"])
+def shopify_inventory_webhook():
+    """Apply inventory_levels/update webhooks to the local inventory mirror."""
+    if not verify_shopify_webhook():
+        return jsonify({"error": "Invalid webhook signature"}), 401
+
+    try:
+        data = request.get_json()
+        logging.info(f"Received Shopify inventory webhook: {data}")
+
+        stored = store_inventory_levels([data], time.time())
+        return jsonify({"status": "success" if stored else "ignored"}), 200
+    except Exception as e:
+        # A non-2xx makes Shopify redeliver, which is what we want here.
+        logging.error(f"Error processing Shopify inventory webhook: {traceback.format_exc()}")
+        return jsonify({"error": str(e)}), 500
 
 
 @app.route("/shopify-webhook", methods=["POST"])
@@ -532,11 +1442,7 @@ def shopify_webhook():
 def find_shopify_customer_by_phone(phone):
     logging.info(f"Searching for customer with phone: {phone}")
     shopify_customer_search_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/customers/search.json?query=phone:{phone}"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
-    response = requests.get(shopify_customer_search_url, headers=headers)
+    response = shopify_request("GET", shopify_customer_search_url)
     logging.info(f"Customer search response: {response.content}")
 
     if response.status_code == 200:
@@ -550,7 +1456,7 @@ def find_shopify_customer_by_phone(phone):
         logging.info(f"Retrying search with phone number: {phone_without_country_code}")
 
         shopify_customer_search_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/customers/search.json?query=phone:{phone_without_country_code}"
-        response = requests.get(shopify_customer_search_url, headers=headers)
+        response = shopify_request("GET", shopify_customer_search_url)
         logging.info(
             f"Customer search response (without country code): {response.content}"
         )
@@ -563,89 +1469,721 @@ def find_shopify_customer_by_phone(phone):
     return None
 
 
-def check_stock_availability(items):
-    """Return names of out-of-stock items (tracked, deny policy, available <
-    requested). Empty list = all fulfillable. Fails open on lookup errors."""
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
+def variant_inventory_fields(variant):
+    """The parts of a Shopify variant the stock check uses."""
+    return {
+        "id": str(variant["id"]),
+        "product_id": str(variant.get("product_id") or ""),
+        "inventory_item_id": str(variant.get("inventory_item_id") or ""),
+        "inventory_management": variant.get("inventory_management") or "",
+        "inventory_policy": variant.get("inventory_policy") or "",
+        "updated_at": variant.get("updated_at"),
+    }
+
+
+def can_run_out(variant):
+    """False for untracked variants and ones the shop lets oversell."""
+    return bool(variant.get("inventory_management")) and (
+        variant.get("inventory_policy") != "continue"
+    )
+
+
+def load_variant_map():
+    """variant id -> stock fields, from the local variant_inventory table."""
+    db = Session()
+    try:
+        rows = db.query(VariantInventory).all()
+    finally:
+        db.close()
+    return {
+        row.variant_id: {
+            "id": row.variant_id,
+            "product_id": row.product_id,
+            "inventory_item_id": row.inventory_item_id,
+            "inventory_management": row.inventory_management,
+            "inventory_policy": row.inventory_policy,
+            "updated_at": row.updated_at,
+        }
+        for row in rows
     }
-    out_of_stock = []
 
+
+# A variant's inventory item and policy almost never change, so stock checks
+# read them from memory and only ask Shopify for variants they haven't seen.
+# products/* webhooks keep the table current; the TTL only bounds how long
+# other workers take to notice.
+variant_map = RefreshingIndex(
+    load_variant_map,
+    ttl=VARIANT_MAP_TTL,
+    stale_ttl=VARIANT_MAP_TTL * 12,
+    name="variant map",
+)
+
+
+def known_variants():
+    """variant_map's contents, or {} while it can't be loaded: it's only a
+    shortcut, and variants missing from it are looked up live."""
+    try:
+        return variant_map.snapshot()
+    except LoadFailed as e:
+        logging.error(f"{e}; looking variants up live")
+        return {}
+
+
+def remember_variants(variants, product_id=None):
+    """Save variants' stock fields to the table and this worker's map. With
+    ``product_id``, ``variants`` is that product's full list and any other
+    variant we had stored for it is dropped."""
+    fields = [variant_inventory_fields(variant) for variant in variants]
+    db = Session()
+    try:
+        if product_id is not None:
+            db.query(VariantInventory).filter(
+                VariantInventory.product_id == str(product_id),
+                ~VariantInventory.variant_id.in_([f["id"] for f in fields]),
+            ).delete(synchronize_session=False)
+        for f in fields:
+            db.merge(
+                VariantInventory(
+                    variant_id=f["id"],
+                    product_id=f["product_id"],
+                    inventory_item_id=f["inventory_item_id"],
+                    inventory_management=f["inventory_management"],
+                    inventory_policy=f["inventory_policy"],
+                    updated_at=f["updated_at"],
+                )
+            )
+        db.commit()
+    finally:
+        db.close()
+
+    if product_id is not None:
+        kept = {f["id"] for f in fields}
+        variant_map.evict_where(
+            lambda key, v: v["product_id"] == str(product_id) and key not in kept
+        )
+    for f in fields:
+        variant_map.put(f["id"], f)
+
+
+def forget_product_variants(product_id):
+    """Drop every stored variant of a deleted product."""
+    db = Session()
+    try:
+        db.query(VariantInventory).filter_by(product_id=str(product_id)).delete()
+        db.commit()
+    finally:
+        db.close()
+    variant_map.evict_where(lambda _key, v: v["product_id"] == str(product_id))
+
+
+def _newer(updated_at, than):
+    """True unless ``than`` is a later Shopify timestamp than ``updated_at``."""
+    if not updated_at or not than:
+        return True
+    try:
+        return datetime.fromisoformat(updated_at) >= datetime.fromisoformat(than)
+    except ValueError:
+        return True
+
+
+def store_inventory_level(db, level, synced_at):
+    """Upsert one inventory level, ignoring it if we already hold a newer one
+    (webhooks can arrive out of order). Returns whether it was stored."""
+    key = (str(level["inventory_item_id"]), str(level["location_id"]))
+    row = db.get(InventoryLevel, key)
+    if row is None:
+        row = InventoryLevel(inventory_item_id=key[0], location_id=key[1])
+        db.add(row)
+    elif not _newer(level.get("updated_at"), row.updated_at):
+        return False
+    row.available = level.get("available")
+    row.updated_at = level.get("updated_at")
+    row.synced_at = synced_at
+    return True
+
+
+def store_inventory_levels(levels, synced_at):
+    """store_inventory_level for a batch, in one transaction. Returns how many
+    were stored. If another worker (or a webhook) inserted one of the rows
+    meanwhile, the batch is retried once, now as updates."""
+    for attempt in range(2):
+        db = Session()
+        try:
+            stored = sum(store_inventory_level(db, level, synced_at) for level in levels)
+            db.commit()
+            return stored
+        except IntegrityError:
+            db.rollback()
+            if attempt:
+                raise
+        finally:
+            db.close()
+
+
+def sync_inventory_levels():
+    """Full paginated copy of every location's inventory levels into the
+    mirror. Levels this sync didn't see (and no webhook touched meanwhile) are
+    dropped."""
+    started = time.time()
+    resp = shopify_request(
+        "GET",
+        f"{SHOPIFY_STORE_URL}/admin/api/2024-10/locations.json",
+        priority=PRIORITY_BACKGROUND,
+    )
+    if resp.status_code != 200:
+        raise RuntimeError(f"locations returned {resp.status_code}: {resp.text}")
+    location_ids = [str(location["id"]) for location in resp.json().get("locations", [])]
+
+    db = Session()
+    try:
+        count = 0
+        for chunk in _chunks(location_ids, 50):
+            params = {"location_ids": ",".join(chunk), "limit": 250}
+            url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/inventory_levels.json?{urlencode(params)}"
+            while url:
+                resp = shopify_request("GET", url, priority=PRIORITY_BACKGROUND)
+                if resp.status_code != 200:
+                    raise RuntimeError(
+                        f"inventory_levels returned {resp.status_code}: {resp.text}"
+                    )
+                count += store_inventory_levels(
+                    resp.json().get("inventory_levels", []), started
+                )
+                url = _next_page_url(resp)
+
+        db.query(InventoryLevel).filter(InventoryLevel.synced_at < started).delete(
+            synchronize_session=False
+        )
+        state = db.get(SyncState, "inventory_levels") or SyncState(name="inventory_levels")
+        state.last_full_sync_at = started
+        state.last_synced_at = time.time()
+        db.merge(state)
+        db.commit()
+        logging.info(f"inventory mirror: synced {count} levels in {time.time() - started:.1f}s")
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+def sync_inventory_levels_if_due():
+    db = Session()
+    try:
+        state = db.get(SyncState, "inventory_levels")
+        last_full = state.last_full_sync_at if state else None
+    finally:
+        db.close()
+    if last_full is None or time.time() - last_full >= INVENTORY_SYNC_INTERVAL:
+        sync_inventory_levels()
+
+
+_inventory_sync_lock = threading.Lock()
+
+
+def start_inventory_sync_if_due():
+    """Run sync_inventory_levels_if_due on a background thread, at most one at
+    a time per worker."""
+    if not _inventory_sync_lock.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            sync_inventory_levels_if_due()
+        except Exception as e:
+            logging.error(f"inventory mirror sync failed: {e}")
+        finally:
+            _inventory_sync_lock.release()
+
+    threading.Thread(target=run, daemon=True, name="inventory-sync").start()
+
+
+def read_inventory_mirror(inventory_item_ids):
+    """{inventory_item_id: total available} from the mirror, for items whose
+    levels are all within INVENTORY_MIRROR_MAX_AGE. Others are left out."""
+    if not inventory_item_ids:
+        return {}
+    db = Session()
+    try:
+        state = db.get(SyncState, "inventory_levels")
+        last_full = (state.last_full_sync_at if state else None) or 0
+        rows = (
+            db.query(
+                InventoryLevel.inventory_item_id,
+                InventoryLevel.available,
+                InventoryLevel.synced_at,
+            )
+            .filter(InventoryLevel.inventory_item_id.in_(list(inventory_item_ids)))
+            .all()
+        )
+    finally:
+        db.close()
+
+    oldest_ok = time.time() - INVENTORY_MIRROR_MAX_AGE
+    totals = {}
+    stale = set()
+    for inventory_item_id, available, synced_at in rows:
+        if max(synced_at or 0, last_full) < oldest_ok:
+            stale.add(inventory_item_id)
+        totals[inventory_item_id] = totals.get(inventory_item_id, 0) + (available or 0)
+    return {k: v for k, v in totals.items() if k not in stale}
+
+
+def stock_snapshot_mirror(items):
+    """Stock from the local inventory mirror; variants it can't answer for
+    (unknown, never synced, or stale) get a live batched check."""
+    start_inventory_sync_if_due()
+
+    known = known_variants()
+    snapshot = {}
+    by_inventory_item = {}  # inventory_item_id -> [item, ...]
+    live = []
+    handled = set()
     for item in items:
         variant_id = item.get("variant_id")
-        requested = int(float(item.get("quantity", 1)))
-        try:
-            variant_resp = shopify_request(
-                "GET",
-                f"{SHOPIFY_STORE_URL}/admin/api/2024-10/variants/{variant_id}.json",
-                headers=headers,
+        if not variant_id or variant_id in handled:
+            continue
+        handled.add(variant_id)
+        variant = known.get(str(variant_id))
+        if variant is None or (can_run_out(variant) and not variant["inventory_item_id"]):
+            live.append(item)
+        elif not can_run_out(variant):
+            snapshot[variant_id] = None
+        else:
+            by_inventory_item.setdefault(variant["inventory_item_id"], []).append(item)
+
+    levels = read_inventory_mirror(by_inventory_item)
+    for inventory_item_id, mirrored_items in by_inventory_item.items():
+        if inventory_item_id not in levels:
+            live.extend(mirrored_items)
+            continue
+        for item in mirrored_items:
+            snapshot[item["variant_id"]] = levels[inventory_item_id]
+
+    if live:
+        logging.info(f"stock check: {len(live)} variant(s) not in the mirror, checking live")
+        snapshot.update(live_stock_snapshot(live))
+    return snapshot
+
+
+def lookup_variant_stock(variant_id):
+    """Live stock for one variant: the available count, None when it can't run
+    out (untracked inventory or "continue" policy), or STOCK_UNKNOWN when the
+    lookup failed and the caller should fail open."""
+    variant = known_variants().get(str(variant_id))
+    if variant is None:
+        variant_resp = shopify_request(
+            "GET",
+            f"{SHOPIFY_STORE_URL}/admin/api/2024-10/variants/{variant_id}.json",
+        )
+        if variant_resp.status_code != 200:
+            logging.error(
+                f"stock check: variant {variant_id} lookup returned "
+                f"{variant_resp.status_code}: {variant_resp.content}"
             )
-            if variant_resp.status_code != 200:
-                logging.error(
-                    f"stock check: variant {variant_id} lookup returned "
-                    f"{variant_resp.status_code}: {variant_resp.content}"
-                )
-                continue  # fail open
-            variant = variant_resp.json().get("variant", {})
+            return STOCK_UNKNOWN  # fail open
+        variant = variant_resp.json().get("variant", {})
+        remember_variants([variant])
 
-            # Untracked inventory -> always sellable.
-            if not variant.get("inventory_management"):
-                continue
-            # Shop allows overselling this variant -> sellable.
-            if variant.get("inventory_policy") == "continue":
-                continue
+    # Untracked inventory, or the shop allows overselling -> always sellable.
+    if not can_run_out(variant):
+        return None
+
+    inventory_item_id = variant.get("inventory_item_id")
+    if not inventory_item_id:
+        logging.error(f"stock check: variant {variant_id} has no inventory_item_id")
+        return STOCK_UNKNOWN  # fail open
+
+    levels_resp = shopify_request(
+        "GET",
+        f"{SHOPIFY_STORE_URL}/admin/api/2024-10/inventory_levels.json"
+        f"?inventory_item_ids={inventory_item_id}",
+    )
+    if levels_resp.status_code != 200:
+        logging.error(
+            f"stock check: inventory_levels returned {levels_resp.status_code} "
+            f"for variant {variant_id}: {levels_resp.content} "
+            "(check the app has the read_inventory scope)"
+        )
+        return STOCK_UNKNOWN  # fail open
+
+    levels = levels_resp.json().get("inventory_levels", [])
+    # No levels returned means we could not determine stock -- never
+    # treat that as zero, or a permissions issue blocks every checkout.
+    if not levels:
+        logging.error(
+            f"stock check: no inventory levels for variant {variant_id} "
+            f"(inventory_item_id {inventory_item_id}) -- allowing checkout"
+        )
+        return STOCK_UNKNOWN  # fail open
 
-            inventory_item_id = variant.get("inventory_item_id")
-            if not inventory_item_id:
-                logging.error(f"stock check: variant {variant_id} has no inventory_item_id")
-                continue  # fail open
+    return sum((lvl.get("available") or 0) for lvl in levels)
 
-            levels_resp = shopify_request(
+
+def get_stock_snapshot(items):
+    """Stock for every distinct variant in ``items``. Returns
+    {variant_id: available}, where None means it can't run out; variants we
+    couldn't determine are left out, so callers fail open on them.
+
+    The whole check gets STOCK_CHECK_DEADLINE_MS; anything unresolved by then
+    is left out too."""
+    return with_deadline(STOCK_CHECK_DEADLINE_MS / 1000, _get_stock_snapshot, items)
+
+
+def _get_stock_snapshot(items):
+    if STOCK_CHECK_MODE == "mirror":
+        return stock_snapshot_mirror(items)
+    return live_stock_snapshot(items)
+
+
+def live_stock_snapshot(items):
+    """get_stock_snapshot straight from Shopify, through stock_cache and
+    stock_flight: only variants nobody has fresh or is already fetching are
+    looked up, the rest are reused or waited for."""
+    snapshot = {}
+    by_key = {}  # str(variant_id) -> first item with that variant
+    for item in items:
+        variant_id = item.get("variant_id")
+        if not variant_id:
+            continue
+        cached = stock_cache.get(str(variant_id), STOCK_UNKNOWN)
+        if cached is not STOCK_UNKNOWN:
+            snapshot[variant_id] = cached
+        else:
+            by_key.setdefault(str(variant_id), item)
+    if not by_key:
+        return snapshot
+
+    mine, theirs = stock_flight.claim(by_key)
+    fetched = {}
+    try:
+        if mine:
+            fetched = fetch_stock_snapshot([by_key[key] for key in mine])
+    finally:
+        results = {str(variant_id): available for variant_id, available in fetched.items()}
+        for key in mine:
+            available = results.get(key, STOCK_UNKNOWN)
+            if available is not STOCK_UNKNOWN:
+                stock_cache.set(key, available)
+            stock_flight.resolve(key, available)
+    snapshot.update(fetched)
+
+    for key, future in theirs.items():
+        try:
+            available = future.result(timeout=deadline_remaining())
+        except TimeoutError:
+            logging.warning(f"stock check: variant {key} not resolved before the deadline")
+            continue  # fail open
+        if available is not STOCK_UNKNOWN:  # unknown -> fail open
+            snapshot[by_key[key]["variant_id"]] = available
+    return snapshot
+
+
+def fetch_stock_snapshot(items):
+    """One uncached live lookup in the configured STOCK_CHECK_MODE ("mirror"
+    falls back to "batched")."""
+    variant_ids = [item.get("variant_id") for item in items]
+    if STOCK_CHECK_MODE == "sequential":
+        return stock_snapshot_sequential(variant_ids)
+    if STOCK_CHECK_MODE == "concurrent":
+        return stock_snapshot_concurrent(variant_ids)
+    return stock_snapshot_batched(items)
+
+
+def stock_snapshot_sequential(variant_ids):
+    """Two Shopify calls per distinct variant, one after another."""
+    snapshot = {}
+    for variant_id in dict.fromkeys(variant_ids):
+        if not variant_id:
+            continue
+        available = _lookup_variant_stock_safely(variant_id)
+        if available is not STOCK_UNKNOWN:
+            snapshot[variant_id] = available
+    return snapshot
+
+
+def _lookup_variant_stock_safely(variant_id):
+    try:
+        return lookup_variant_stock(variant_id)
+    except Exception as e:
+        logging.error(f"Stock check failed for variant {variant_id}: {e}")
+        return STOCK_UNKNOWN  # fail open
+
+
+def stock_snapshot_concurrent(variant_ids):
+    """stock_snapshot_sequential with the lookups fanned out over
+    stock_lookup_pool. shopify_request paces them to the shared rate limit."""
+    variant_ids = [v for v in dict.fromkeys(variant_ids) if v]
+    if len(variant_ids) <= 1:
+        return stock_snapshot_sequential(variant_ids)
+    # Each task runs in a copy of our context, so it keeps upstream_deadline.
+    futures = [
+        stock_lookup_pool.submit(
+            contextvars.copy_context().run, _lookup_variant_stock_safely, variant_id
+        )
+        for variant_id in variant_ids
+    ]
+    snapshot = {}
+    for variant_id, future in zip(variant_ids, futures):
+        try:
+            available = future.result(timeout=deadline_remaining())
+        except TimeoutError:
+            logging.warning(f"stock check: variant {variant_id} not resolved before the deadline")
+            continue  # fail open
+        if available is not STOCK_UNKNOWN:
+            snapshot[variant_id] = available
+    return snapshot
+
+
+def _chunks(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def stock_snapshot_batched(items):
+    """The same answer as stock_snapshot_sequential in (usually) two calls:
+    one products.json?ids= for every product in the cart -- the REST API has
+    no multi-id variant fetch, but products carry their variants -- then one
+    inventory_levels.json for every tracked inventory item."""
+    snapshot = {}
+
+    tracked = {}  # inventory_item_id -> [variant_id, ...]
+
+    def classify(variant_id, variant):
+        if not can_run_out(variant):
+            snapshot[variant_id] = None
+        elif not variant.get("inventory_item_id"):
+            logging.error(f"stock check: variant {variant_id} has no inventory_item_id")
+        else:
+            tracked.setdefault(str(variant["inventory_item_id"]), []).append(variant_id)
+
+    # Variants we've seen before need no products call at all.
+    known = known_variants()
+    wanted = {}  # str(variant_id) -> variant_id as the cart sent it
+    product_ids = []
+    without_product = []
+    handled = set()
+    for item in items:
+        variant_id = item.get("variant_id")
+        if not variant_id or variant_id in handled:
+            continue
+        handled.add(variant_id)
+        if str(variant_id) in known:
+            classify(variant_id, known[str(variant_id)])
+        elif not item.get("product_id"):
+            without_product.append(variant_id)
+        else:
+            wanted[str(variant_id)] = variant_id
+            product_ids.append(str(item["product_id"]))
+
+    seen = set()
+    for chunk in _chunks(list(dict.fromkeys(product_ids)), 250):
+        params = {"ids": ",".join(chunk), "fields": "id,variants", "limit": 250}
+        try:
+            resp = shopify_request(
                 "GET",
-                f"{SHOPIFY_STORE_URL}/admin/api/2024-10/inventory_levels.json"
-                f"?inventory_item_ids={inventory_item_id}",
-                headers=headers,
+                f"{SHOPIFY_STORE_URL}/admin/api/2024-10/products.json?{urlencode(params)}",
             )
-            if levels_resp.status_code != 200:
-                logging.error(
-                    f"stock check: inventory_levels returned {levels_resp.status_code} "
-                    f"for variant {variant_id}: {levels_resp.content} "
-                    "(check the app has the read_inventory scope)"
-                )
-                continue  # fail open
+        except Exception as e:
+            logging.error(f"stock check: products lookup failed for {chunk}: {e}")
+            continue  # fail open
+        if resp.status_code != 200:
+            logging.error(
+                f"stock check: products lookup returned {resp.status_code} "
+                f"for {chunk}: {resp.content}"
+            )
+            continue  # fail open
+        for product in resp.json().get("products", []):
+            variants = product.get("variants", [])
+            remember_variants(variants, product_id=product["id"])
+            for variant in variants:
+                variant_id = wanted.get(str(variant.get("id")))
+                if variant_id is None:
+                    continue
+                seen.add(str(variant_id))
+                classify(variant_id, variant)
+
+    for key, variant_id in wanted.items():
+        if key not in seen:
+            logging.error(f"stock check: variant {variant_id} not found on its product")
+
+    # inventory_levels takes at most 50 inventory_item_ids per call.
+    for chunk in _chunks(list(tracked), 50):
+        totals = {}
+        params = {"inventory_item_ids": ",".join(map(str, chunk)), "limit": 250}
+        url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/inventory_levels.json?{urlencode(params)}"
+        try:
+            while url:
+                resp = shopify_request("GET", url)
+                if resp.status_code != 200:
+                    raise RuntimeError(
+                        f"inventory_levels returned {resp.status_code}: {resp.content} "
+                        "(check the app has the read_inventory scope)"
+                    )
+                for level in resp.json().get("inventory_levels", []):
+                    inventory_item_id = str(level.get("inventory_item_id"))
+                    totals[inventory_item_id] = totals.get(inventory_item_id, 0) + (
+                        level.get("available") or 0
+                    )
+                url = _next_page_url(resp)
+        except Exception as e:
+            logging.error(f"stock check: {e} for inventory items {chunk}")
+            continue  # fail open
 
-            levels = levels_resp.json().get("inventory_levels", [])
-            # No levels returned means we could not determine stock -- never
-            # treat that as zero, or a permissions issue blocks every checkout.
-            if not levels:
+        for inventory_item_id in chunk:
+            # No levels means we could not determine stock -- never treat
+            # that as zero, or a permissions issue blocks every checkout.
+            if inventory_item_id not in totals:
                 logging.error(
-                    f"stock check: no inventory levels for variant {variant_id} "
-                    f"(inventory_item_id {inventory_item_id}) -- allowing checkout"
+                    f"stock check: no inventory levels for inventory_item_id "
+                    f"{inventory_item_id} -- allowing checkout"
                 )
-                continue  # fail open
+                continue
+            for variant_id in tracked[inventory_item_id]:
+                snapshot[variant_id] = totals[inventory_item_id]
 
-            available = sum((lvl.get("available") or 0) for lvl in levels)
-            logging.info(
-                f"stock check: variant {variant_id} available {available}, requested {requested}"
+    if without_product:
+        snapshot.update(stock_snapshot_concurrent(without_product))
+    return snapshot
+
+
+def stock_check_summary(items, snapshot):
+    """How many cart lines the snapshot verified, and how many were assumed in
+    stock because their lookup failed or ran out of time (logged)."""
+    assumed = [
+        item.get("name", str(item.get("variant_id")))
+        for item in items
+        if item.get("variant_id") not in snapshot
+    ]
+    if assumed:
+        logging.warning(f"stock check: assuming in stock, not verified: {assumed}")
+    return {"verified": len(items) - len(assumed), "assumed": len(assumed)}
+
+
+def out_of_stock_items(items, snapshot):
+    """Names of items whose variant's requested quantity, summed over every
+    cart line with that variant, exceeds the snapshot."""
+    requested = {}
+    for item in items:
+        variant_id = item.get("variant_id")
+        requested[variant_id] = requested.get(variant_id, 0) + int(
+            float(item.get("quantity", 1))
+        )
+
+    short = set()
+    for variant_id, quantity in requested.items():
+        available = snapshot.get(variant_id)
+        if available is None:
+            continue  # can't run out, or unknown -> fail open
+        logging.info(
+            f"stock check: variant {variant_id} available {available}, requested {quantity}"
+        )
+        if available < quantity:
+            short.add(variant_id)
+    return [
+        item.get("name", str(item.get("variant_id")))
+        for item in items
+        if item.get("variant_id") in short
+    ]
+
+
+def held_quantities(db, variant_ids, now):
+    """{variant_id (str): quantity} held by other unpaid, unexpired checkouts."""
+    rows = (
+        db.query(StockReservation.variant_id, func.sum(StockReservation.quantity))
+        .filter(
+            StockReservation.variant_id.in_([str(v) for v in variant_ids]),
+            StockReservation.status == "held",
+            StockReservation.expires_at > now,
+        )
+        .group_by(StockReservation.variant_id)
+        .all()
+    )
+    return dict(rows)
+
+
+def reserve_stock(items, snapshot):
+    """Check ``items`` against ``snapshot`` less what other checkouts hold and,
+    if everything fits, hold it. Returns (reservation_id or None, names of
+    out-of-stock items).
+
+    The check and the insert run in one BEGIN IMMEDIATE transaction, so two
+    workers can't both take the last unit. Variants that can't run out or
+    whose stock is unknown aren't held (fail open)."""
+    tracked = [item for item in items if snapshot.get(item.get("variant_id")) is not None]
+    if not tracked:
+        return None, []
+
+    reservation_id = uuid.uuid4().hex
+    now = time.time()
+    db = Session()
+    try:
+        db.execute(text("BEGIN IMMEDIATE"))
+        held = held_quantities(db, [item["variant_id"] for item in tracked], now)
+        available = {
+            variant_id: stock - held.get(str(variant_id), 0)
+            for variant_id, stock in snapshot.items()
+            if stock is not None
+        }
+        out_of_stock = out_of_stock_items(items, available)
+        if out_of_stock:
+            db.rollback()
+            return None, out_of_stock
+
+        for item in tracked:
+            db.add(
+                StockReservation(
+                    reservation_id=reservation_id,
+                    variant_id=str(item["variant_id"]),
+                    quantity=int(float(item.get("quantity", 1))),
+                    status="held",
+                    created_at=now,
+                    expires_at=now + STOCK_RESERVATION_TTL,
+                )
             )
-            if available < requested:
-                out_of_stock.append(item.get("name", str(variant_id)))
-        except Exception as e:
-            logging.error(f"Stock check failed for variant {variant_id}: {e}")
-            continue  # fail open
+        # Old finished or expired holds are only noise from here on.
+        db.query(StockReservation).filter(
+            StockReservation.expires_at < now - 86400
+        ).delete(synchronize_session=False)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+    logging.info(f"stock reservation {reservation_id}: held {len(tracked)} line(s)")
+    return reservation_id, []
+
+
+def finish_reservation(reservation_id, status):
+    """Mark a checkout's held stock "consumed" (paid) or "released"."""
+    if not reservation_id:
+        return
+    db = Session()
+    try:
+        updated = (
+            db.query(StockReservation)
+            .filter_by(reservation_id=reservation_id, status="held")
+            .update({"status": status}, synchronize_session=False)
+        )
+        db.commit()
+    finally:
+        db.close()
+    logging.info(f"stock reservation {reservation_id}: {updated} line(s) {status}")
 
-    return out_of_stock
+
+def check_stock_availability(items):
+    """Return names of out-of-stock items (tracked, deny policy, available <
+    requested). Empty list = all fulfillable. Fails open on lookup errors."""
+    snapshot = get_stock_snapshot(items)
+    return out_of_stock_items(items, snapshot)
 
 
 def find_shopify_customer_by_email(email):
     logging.info(f"Searching for customer with email: {email}")
     shopify_customer_search_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/customers/search.json?query=email:{email}"
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
-    response = shopify_request("GET", shopify_customer_search_url, headers=headers)
+    response = shopify_request("GET", shopify_customer_search_url)
     logging.info(f"Customer search response: {response.content}")
 
     if response.status_code == 200:
@@ -664,8 +2202,10 @@ def create_shopify_order(
     items,
     metafields,
     coupon_code=None,
+    discount_snapshot=None,
     financial_status="paid",
     email_marketing_consent_state=None,
+    claim_id=None,
 ):
     customer = find_shopify_customer_by_email(email)
 
@@ -673,10 +2213,7 @@ def create_shopify_order(
     shopify_order_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/orders.json"
     shopify_customer_update_url = f"{SHOPIFY_STORE_URL}/admin/api/2024-10/customers"
 
-    headers = {
-        "X-Shopify-Access-Token": SHOPIFY_API_KEY,
-        "Content-Type": "application/json",
-    }
+    headers = SHOPIFY_HEADERS
 
     # Split full name into first_name and last_name
     name_parts = name.split(" ", 1)
@@ -718,7 +2255,13 @@ def create_shopify_order(
 
     #Apply coupon code if any
     discount_codes = []
-    if coupon_code:
+    snapshot = load_discount_snapshot(discount_snapshot) if discount_snapshot else None
+    if snapshot and snapshot["code"] == coupon_code:
+        discount_codes = discount_codes_from_snapshot(snapshot)
+        logging.info(f"Applied checkout discount snapshot: {snapshot}")
+    elif coupon_code:
+        # Purchases created before snapshots existed: validate again. A failed
+        # lookup raises (the webhook is retried) rather than dropping the code.
         coupon_is_valid, discount_value, value_type = validate_shopify_coupon(
             coupon_code
         )
@@ -762,24 +2305,9 @@ def create_shopify_order(
 
     # Shipping fee based on country and province
     requires_shipping = any(p["requires_shipping"] for p in items)
-
-    if not requires_shipping:
-        shipping_fee = 0.00
-    else:
-        if shipping_address['country'] == "MY":
-            # Sabah, Sarawak, Labuan (MY-12 = Sabah, MY-13 = Sarawak, MY-15 = Labuan)
-            if shipping_address["province"] in ["MY-12", "MY-13", "MY-15"]:
-                shipping_fee = 9.00
-            else:
-                shipping_fee = 7.00
-        elif shipping_address['country'] == "SG":
-            shipping_fee = 40.00
-        elif shipping_address['country'] == "BN":
-            shipping_fee = 70.00
-        elif shipping_address['country'] == "ID":
-            shipping_fee = 110.00
-        else:
-            shipping_fee = 0.00  # default for other countries
+    shipping_fee = shipping_fee_for(
+        shipping_address["country"], shipping_address["province"], requires_shipping
+    )
 
     order_metafields = [
         {
@@ -792,7 +2320,12 @@ def create_shopify_order(
 
     if metafields['formType'] == 'academy':
         line_items = items
-        class_id = update_purchase_counts( line_items, SHOPIFY_STORE_URL, headers)
+        try:
+            class_id = update_purchase_counts( line_items, SHOPIFY_STORE_URL, headers)
+        except (RateLimited, TimeoutError, CircuitOpen, requests.RequestException) as e:
+            # Never lose a paid order over its class_id.
+            logging.error(f"Purchase count update failed, order goes without class_id: {e}")
+            class_id = None
         if class_id:
             print(f"Class_id metafield data: {class_id}")
             order_metafields.append(class_id)
@@ -901,9 +2434,7 @@ def create_shopify_order(
         order_data["order"]["tags"] = "invalid-quantity-check-stock"
 
     logging.info(f"order_data line_items: {order_data['order']['line_items']}")
-    response = shopify_request(
-        "POST", shopify_order_url, json=order_data, headers=headers
-    )
+    response = post_shopify_order(shopify_order_url, order_data, claim_id)
     logging.info(f"POST shopify order url: {response.content}")
 
     # Paid-but-out-of-stock safety net: the customer has ALREADY paid, so we
@@ -923,9 +2454,7 @@ def create_shopify_order(
             if existing_tags
             else "oversold-check-stock"
         )
-        response = shopify_request(
-            "POST", shopify_order_url, json=order_data, headers=headers
-        )
+        response = post_shopify_order(shopify_order_url, order_data, claim_id)
         logging.info(f"POST shopify order url (oversell retry): {response.content}")
 
     # Log the response for debugging
@@ -946,18 +2475,26 @@ def create_shopify_order(
 
             # Update email marketing consent if provided
             if email_marketing_consent_state:
-                update_customer_email_consent(
-                    f"{shopify_customer_update_url}/{customer_id}.json",
-                    customer_id,
-                    email_marketing_consent_state,
-                    headers,
-                )
+                try:
+                    update_customer_email_consent(
+                        f"{shopify_customer_update_url}/{customer_id}.json",
+                        customer_id,
+                        email_marketing_consent_state,
+                        headers,
+                    )
+                except Exception as e:
+                    # The order exists; nothing after this point may fail the
+                    # webhook.
+                    logging.error(f"Email consent update failed for customer {customer_id}: {e}")
 
         return response_json  # Return the created order details
     else:
         logging.error(
             f"Failed to create order in Shopify. Status Code: {response.status_code}, Response: {response.text}"
         )
+        if response.status_code == 429:
+            # Throttled before Shopify did anything: safe for the retry.
+            mark_purchase_claim(claim_id, "processing")
         return None
 
 
@@ -977,7 +2514,13 @@ def update_customer_email_consent(
     }
 
     # Make the PUT request to update the customer
-    response = requests.put(customer_update_url, json=customer_data, headers=headers)
+    response = shopify_request(
+        "PUT",
+        customer_update_url,
+        json=customer_data,
+        headers=headers,
+        priority=PRIORITY_BACKGROUND,
+    )
     logging.info(f"Request made to Shopify: {response.status_code}, {response.text}")
     logging.info(f"Customer Email Subscription Update: {response.content}")
     if response.status_code == 200:
@@ -993,6 +2536,19 @@ def update_customer_email_consent(
 # Flask endpoint to validate the coupon
 @app.route("/validate-coupon", methods=["POST"])
 def validate_coupon():
+    allowed, retry_after = coupon_throttle.try_acquire(client_ip())
+    if not allowed:
+        return (
+            jsonify(
+                {
+                    "valid": False,
+                    "message": "Too many coupon attempts, please try again shortly",
+                }
+            ),
+            429,
+            {"Retry-After": str(math.ceil(retry_after))},
+        )
+
     # Get the coupon code from the request body
     data = request.get_json()
     coupon_code = data.get("coupon_code")
@@ -1001,53 +2557,151 @@ def validate_coupon():
     if not coupon_code:
         return jsonify({"valid": False, "message": "No coupon code provided"}), 400
 
-    # Validate the coupon code with Shopify
-    coupon_is_valid, discount_value, value_type = validate_shopify_coupon(coupon_code)
+    # Validate the coupon code with Shopify and price the cart with it
+    try:
+        discount, quote = quote_cart(items, coupon_code, basis="unit")
+    except CouponLookupFailed as e:
+        return (
+            jsonify(
+                {
+                    "valid": False,
+                    "message": "Couldn't check the coupon right now, please try again shortly",
+                }
+            ),
+            503,
+            {"Retry-After": str(math.ceil(e.retry_after))},
+        )
 
-    discount_balance = 2000  # 2000 sen = 20 ringgit
+    if discount is None:
+        return jsonify({"valid": False, "message": "Invalid coupon code"}), 400
 
-    total_price_before_discount = 0
-    total_price_after_discount = 0
+    return (
+        jsonify(
+            {
+                "valid": True,
+                "discount": str(discount.value),
+                "items": items,
+                "total_price_before_discount": quote.subtotal.sen,
+                "total_price_after_discount": (quote.subtotal - quote.discount).sen,
+                "discount_value": quote.discount.sen,
+            }
+        ),
+        200,
+    )
 
-    for item in items:
-        price = float(item["price"]) * float(item["quantity"])
-        total_price_before_discount += price
-
-        if discount_balance > 0:
-            calculated_item_price = calculate_price_based_on_discount(
-                price,
-                float(discount_value),
-                value_type,
-            )
 
-            if price - calculated_item_price > discount_balance:
-                calculated_item_price = price - discount_balance
 
-            discount_balance -= price - calculated_item_price
+@app.route("/cache-stats", methods=["GET"])
+def cache_stats():
+    return (
+        jsonify(
+            {
+                "quotes": quote_cache.stats(),
+                "coupon_lookups": coupon_lookup_cache.stats(),
+                "stock": {**stock_cache.stats(), "coalesced": stock_flight.coalesced},
+            }
+        ),
+        200,
+    )
 
-        else:
-            calculated_item_price = price
 
-        total_price_after_discount += calculated_item_price
+def is_quotable_cart(cart):
+    """A batch cart is an object whose "items" (if any) is a list of objects."""
+    if not isinstance(cart, dict):
+        return False
+    items = cart.get("items") or []
+    return isinstance(items, list) and all(isinstance(item, dict) for item in items)
+
 
-    if coupon_is_valid:
+# Flask endpoint to price many carts at once (cart re-pricing, upsell widgets)
+@app.route("/quote/batch", methods=["POST"])
+def quote_batch():
+    allowed, retry_after = coupon_throttle.try_acquire(client_ip())
+    if not allowed:
         return (
-            jsonify(
-                {
-                    "valid": True,
-                    "discount": discount_value,
-                    "items": items,
-                    "total_price_before_discount": total_price_before_discount,
-                    "total_price_after_discount": total_price_after_discount,
-                    "discount_value": total_price_before_discount
-                    - total_price_after_discount,
-                }
-            ),
-            200,
+            jsonify({"error": "Too many requests, please try again shortly"}),
+            429,
+            {"Retry-After": str(math.ceil(retry_after))},
         )
-    else:
-        return jsonify({"valid": False, "message": "Invalid coupon code"}), 400
-    
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"error": "Expected a JSON object"}), 400
+    carts = data.get("carts") or []
+    coupon_code = data.get("coupon_code")
+
+    if not isinstance(carts, list):
+        return jsonify({"error": "carts must be a list"}), 400
+    if not carts:
+        return jsonify({"error": "No carts provided"}), 400
+    if len(carts) > QUOTE_BATCH_MAX_CARTS:
+        return (
+            jsonify({"error": f"At most {QUOTE_BATCH_MAX_CARTS} carts per batch"}),
+            400,
+        )
+
+    # One coupon lookup for the whole batch.
+    discount = None
+    coupon_is_valid = False
+    if coupon_code:
+        try:
+            coupon_is_valid, discount_value, value_type = validate_shopify_coupon(
+                coupon_code
+            )
+        except CouponLookupFailed as e:
+            return (
+                jsonify({"error": "Couldn't check the coupon right now, please try again shortly"}),
+                503,
+                {"Retry-After": str(math.ceil(e.retry_after))},
+            )
+        if coupon_is_valid:
+            discount = Discount.from_rule(coupon_code, discount_value, value_type)
+
+    # Malformed carts get their own error below and stay out of the snapshot.
+    valid = [is_quotable_cart(cart) for cart in carts]
+
+    # One stock snapshot covering every variant in every cart.
+    snapshot = {}
+    if data.get("check_stock", True):
+        snapshot = get_stock_snapshot(
+            [
+                item
+                for cart, ok in zip(carts, valid)
+                if ok
+                for item in cart.get("items") or []
+            ]
+        )
+
+    quotes = []
+    for cart, ok in zip(carts, valid):
+        if not ok:
+            quotes.append({"error": "Invalid cart: expected an object with a list of item objects"})
+            continue
+        items = cart.get("items") or []
+        # Checkout charges final_line_price; bare carts fall back to price x qty.
+        basis = "final" if all("final_line_price" in i for i in items) else "unit"
+        try:
+            quote = quote_items(
+                items, discount, cart.get("country"), cart.get("province"), basis=basis
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            quotes.append({"error": f"Invalid cart: {e}"})
+            continue
+        result = quote.as_dict()
+        result["out_of_stock"] = out_of_stock_items(items, snapshot)
+        quotes.append(result)
+
+    return (
+        jsonify(
+            {
+                "coupon": {"code": coupon_code, "valid": coupon_is_valid},
+                "quotes": quotes,
+            }
+        ),
+        200,
+    )
+
+
 def update_purchase_counts(line_items, shopify_store_url, headers):
     """
     Update order metafields for purchase counts.
@@ -1075,13 +2729,17 @@ def update_purchase_counts(line_items, shopify_store_url, headers):
         metafield_url = f"{shopify_store_url}/admin/api/2024-10/products/{product_id}/metafields.json"
 
         # 1️⃣ Fetch existing metafields for this product
-        resp = requests.get(metafield_url, headers=headers)
+        # The class_id goes into the paid order, so these calls are part of
+        # creating it and share its lane.
+        resp = shopify_request("GET", metafield_url, headers=headers, priority=PRIORITY_ORDER_WRITE)
         if resp.status_code != 200:
             logging.warning(f"Failed to fetch metafields for product {product_id}: {resp.text}")
             continue
 
         product_url = f"{shopify_store_url}/admin/api/2024-10/products/{product_id}.json"
-        product_resp = requests.get(product_url, headers=headers)
+        product_resp = shopify_request(
+            "GET", product_url, headers=headers, priority=PRIORITY_ORDER_WRITE
+        )
 
         if product_resp.status_code != 200:
             logging.warning(f"Failed to fetch product {product_id}: {product_resp.text}")
@@ -1126,7 +2784,10 @@ def update_purchase_counts(line_items, shopify_store_url, headers):
                     "value": str(new_value)
                 }
             }
-            update_resp = requests.put(update_url, headers=headers, json=update_payload)
+            update_resp = shopify_request(
+                "PUT", update_url, headers=headers, json=update_payload,
+                priority=PRIORITY_ORDER_WRITE,
+            )
             action = "Updated"
         else:
             logging.info(f"not existing metafield, creating new one")
@@ -1138,7 +2799,10 @@ def update_purchase_counts(line_items, shopify_store_url, headers):
                     "value": str(new_value)
                 }
             }
-            update_resp = requests.post(metafield_url, headers=headers, json=create_payload)
+            update_resp = shopify_request(
+                "POST", metafield_url, headers=headers, json=create_payload,
+                priority=PRIORITY_ORDER_WRITE,
+            )
             action = "Created"
 
         if update_resp.status_code in [200, 201]:
@@ -1198,6 +2862,12 @@ def parse_academy_tags(tags_list, purchase_count):
     return class_id
 
 
+# Load the variant map now rather than on the first checkout, and start the
+# first price rule sync off the request path.
+known_variants()
+coupon_index.warm()
+
+
 # Start the Flask server
 if __name__ == "__main__":
     register_shopify_webhook()  # Register webhook at server start if needed
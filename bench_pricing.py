@@ -0,0 +1,431 @@
+"""Pricing benchmark suite. Runs offline.
+
+First checks that the integer-sen engine (pricing.py) prices a set of
+hand-written sample carts exactly like the float loop it replaced in
+create_chip_in_session, and that the NumPy path agrees with the per-line one.
+Then replays a corpus of cart shapes (1/10/100/1000 lines, percentage vs
+fixed_amount, capped vs uncapped) through each pricing target and reports
+per-cart latency and peak allocation.
+
+Both built-in sets are synthetic, not taken from real orders. To check and
+time real (anonymized) carts, supply them with --corpus.
+
+    python bench_pricing.py --json results.json
+    python bench_pricing.py --compare results.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import statistics
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from decimal import Decimal, ROUND_HALF_UP
+
+import pricing
+from pricing import Discount, Money, quote_items
+
+
+# --- The checkout pricing as it was before pricing.py, kept as the reference ---
+
+def calculate_price_based_on_discount(
+    price,
+    discount_value,
+    value_type,
+    override=0,
+):
+    if value_type == "percentage" and override:
+        discount_amount = price * discount_value / 100
+        return price + discount_amount  # discount amount is in negative
+
+    elif value_type == "percentage":
+        discount_amount = price * discount_value / 100
+        return price + discount_amount  # discount amount is in negative
+
+    elif value_type == "fixed_amount":
+        discount_value = discount_value * 100
+
+        if price <= -discount_value:
+            return 0.1
+        else:
+            return price + discount_value
+
+    else:
+        return 0
+
+
+def legacy_checkout_total(items, coupon, country, province):
+    coupon_is_valid = coupon is not None
+    discount_value, value_type = coupon or (0, None)
+
+    requires_shipping = any(item.get("requires_shipping", True) for item in items)
+
+    if requires_shipping != True:
+        shipping_fee = 0
+    elif country == "MY":
+        if province in ["MY-12", "MY-13", "MY-15"]:
+            shipping_fee = 900
+        else:
+            shipping_fee = 700
+    else:
+        shipping_fee = {
+            "SG": 4000,
+            "BN": 7000,
+            "ID": 11000
+        }.get(country, 0)
+
+    discount_balance = 2000  # 2000 sen = 20 ringgit
+
+    total_override = 0
+
+    for item in items:
+        # validate: original_price * quantity = original_line_price
+        # recheck this
+        if round(float(item["original_price"]), 2) != round(float(item["original_price"]) * float(item["quantity"]), 2):
+            raise ValueError("Item price mismatch this")
+
+        # validate: final_line_price = original_line_price - total_discount
+        if round(float(item["final_line_price"]), 2) != round(float(item["original_line_price"]) - float(item["total_discount"]), 2):
+            raise ValueError("Item price mismatch that")
+
+        price = float(item["final_line_price"])
+
+        if coupon_is_valid:
+            calculated_item_price = calculate_price_based_on_discount(
+                price,
+                float(discount_value),
+                value_type,
+            )
+
+            if price - calculated_item_price > discount_balance:
+                calculated_item_price = price - discount_balance
+                coupon_is_valid = False
+
+            discount_balance -= price - calculated_item_price
+
+        else:
+            calculated_item_price = price
+
+        total_override += calculated_item_price
+
+    total_override += shipping_fee  # shipping fee
+    return total_override
+
+
+# --- Sample carts (synthetic: hand-written to hit the edge cases) ---
+
+def line(variant_id, price, total_discount=0, requires_shipping=True):
+    # One unit per line: the checkout's original_price check only passes then.
+    return {
+        "product_id": variant_id // 100,
+        "variant_id": variant_id,
+        "name": f"item {variant_id}",
+        "quantity": 1,
+        "price": price,
+        "original_price": price,
+        "original_line_price": price,
+        "total_discount": total_discount,
+        "final_line_price": price - total_discount,
+        "requires_shipping": requires_shipping,
+    }
+
+
+SAMPLE_CARTS = [
+    # (label, items, coupon (value, value_type) or None, country, province)
+    ("jersey, 10% coupon", [line(10101, 15900)], ("-10.0", "percentage"), "MY", "MY-10"),
+    ("two jerseys, capped 15%", [line(10101, 15900), line(10202, 15900)], ("-15.0", "percentage"), "MY", "MY-12"),
+    ("kit + socks, RM5 off per line", [line(10303, 8900), line(10404, 1900)], ("-5.0", "fixed_amount"), "MY", "MY-14"),
+    ("socks, RM30 off (line goes free)", [line(10404, 1900)], ("-30.0", "fixed_amount"), "MY", "MY-10"),
+    ("automatic discount + coupon", [line(10505, 12900, 1290), line(10606, 4500)], ("-10.0", "percentage"), "SG", None),
+    ("odd prices, 7% coupon", [line(10707, 1999), line(10808, 2999), line(10909, 999)], ("-7.0", "percentage"), "BN", None),
+    ("no coupon, Indonesia", [line(11010, 25900), line(11111, 25900)], None, "ID", None),
+    ("academy slot, no shipping", [line(11212, 35000, requires_shipping=False)], ("-10.0", "percentage"), "MY", "MY-10"),
+]
+
+
+def engine_checkout_total(items, coupon, country, province):
+    discount = Discount.from_rule("BENCH", *coupon) if coupon else None
+    return quote_items(items, discount, country, province, validate=True).total.sen
+
+
+def to_sen(amount):
+    return int(Decimal(str(amount)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def check_sample_carts():
+    mismatches = 0
+    for label, items, coupon, country, province in SAMPLE_CARTS:
+        legacy = legacy_checkout_total(items, coupon, country, province)
+        engine = engine_checkout_total(items, coupon, country, province)
+        same = to_sen(legacy) == engine
+        mismatches += not same
+        print(
+            f"{label:34} legacy {legacy:>10} engine {engine:>8} "
+            f"{'ok' if same else 'MISMATCH'}"
+        )
+    return mismatches
+
+
+def check_vectorized(corpus):
+    if pricing.np is None:
+        print("numpy not installed; skipping the vectorized comparison")
+        return 0
+    mismatches = 0
+    for case in corpus:
+        discount = Discount.from_rule("BENCH", *case["coupon"])
+        args = (
+            case["items"], discount, case["country"], case["province"], "final", True,
+            pricing.DISCOUNT_CAP_SEN,
+        )
+        scalar = pricing._quote_items_scalar(*args)
+        vectorized = pricing._quote_items_vectorized(*args)
+        if scalar.as_dict() != vectorized.as_dict() or scalar.lines != vectorized.lines:
+            mismatches += 1
+            print(f"{case['name']}: vectorized quote differs from the per-line loop")
+    return mismatches
+
+
+# --- Benchmark corpus ---
+#
+# Synthetic carts generated from a fixed seed: line prices are drawn from the
+# catalogue's price points, about a quarter of lines carry an automatic
+# discount, and the destination mix is made up. They are not taken from
+# order history; real anonymized carts must be supplied with --corpus.
+
+CATALOGUE_PRICES = [1900, 2900, 4500, 8900, 12900, 15900, 25900, 35000]
+DESTINATIONS = [("MY", "MY-10")] * 6 + [("MY", "MY-12"), ("MY", "MY-13"), ("SG", None), ("BN", None)]
+CORPUS_SIZES = (1, 10, 100, 1000)
+
+
+def corpus_cart(lines, rng):
+    return [
+        line(
+            30000 + i,
+            price := rng.choice(CATALOGUE_PRICES),
+            total_discount=price // 10 if rng.random() < 0.25 else 0,
+        )
+        for i in range(lines)
+    ]
+
+
+def corpus_coupon(items, value_type, capped):
+    """A coupon that will (``capped``) or won't hit the order cap on this cart."""
+    if capped:
+        return ("-50.0", "percentage") if value_type == "percentage" else ("-30.0", "fixed_amount")
+    # Aim for about a quarter of the cap so it never kicks in.
+    target = pricing.DISCOUNT_CAP_SEN // 4
+    if value_type == "percentage":
+        subtotal = sum(item["final_line_price"] for item in items)
+        percent = Decimal(target * 100) / subtotal
+        # On huge carts that rounds to nothing per line; keep at least half a
+        # sen on an average line so the coupon still does something.
+        percent = max(percent, Decimal(50 * len(items)) / subtotal)
+        percent = percent.quantize(Decimal("0.0001"), rounding="ROUND_UP")
+        return (str(-percent), "percentage")
+    per_line_sen = max(target // len(items), 1)
+    return (str(-Decimal(per_line_sen) / 100), "fixed_amount")
+
+
+def build_corpus(seed=1):
+    rng = random.Random(seed)
+    corpus = []
+    for lines in CORPUS_SIZES:
+        items = corpus_cart(lines, rng)
+        country, province = rng.choice(DESTINATIONS)
+        for value_type in ("percentage", "fixed_amount"):
+            for capped in (False, True):
+                corpus.append(
+                    {
+                        "name": f"{lines}-lines/{value_type}/{'capped' if capped else 'uncapped'}",
+                        "lines": lines,
+                        "value_type": value_type,
+                        "capped": capped,
+                        "country": country,
+                        "province": province,
+                        "coupon": list(corpus_coupon(items, value_type, capped)),
+                        "items": items,
+                    }
+                )
+    return corpus
+
+
+# --- What gets timed: each target prices one whole cart ---
+
+def legacy_line_calls(case):
+    value, value_type = case["coupon"]
+    for item in case["items"]:
+        calculate_price_based_on_discount(float(item["final_line_price"]), float(value), value_type)
+
+
+def engine_line_calls(case):
+    discount = Discount.from_rule("BENCH", *case["coupon"])
+    for item in case["items"]:
+        discount.line_discount(Money.from_sen(item["final_line_price"]))
+
+
+def forced_path(quote_fn):
+    def run(case):
+        discount = Discount.from_rule("BENCH", *case["coupon"])
+        quote_fn(
+            case["items"], discount, case["country"], case["province"], "final", True,
+            pricing.DISCOUNT_CAP_SEN,
+        )
+    return run
+
+
+def validate_coupon_endpoint():
+    """POST /validate-coupon through Flask's test client, with the coupon
+    answered from memory and the quote cache and throttle out of the way, so
+    only our own request handling and pricing are measured. None if the app
+    can't be imported here."""
+    try:
+        import logging
+        import app as app_module
+        from ratelimit import KeyedRateLimiter
+    except Exception as e:
+        print(f"skipping /validate-coupon: app not importable ({e})")
+        return None
+    logging.disable(logging.CRITICAL)
+    app_module.coupon_throttle = KeyedRateLimiter(rate=1e9, capacity=1e9)
+    client = app_module.app.test_client()
+
+    def run(case):
+        value, value_type = case["coupon"]
+        app_module.validate_shopify_coupon = lambda code: (True, value, value_type)
+        app_module.quote_cache.clear()
+        response = client.post(
+            "/validate-coupon", json={"coupon_code": "BENCH", "items": case["items"]}
+        )
+        assert response.status_code == 200, response.get_json()
+
+    return run
+
+
+def targets():
+    found = {
+        "legacy_checkout_loop": lambda case: legacy_checkout_total(
+            case["items"], case["coupon"], case["country"], case["province"]
+        ),
+        "quote_items": lambda case: engine_checkout_total(
+            case["items"], case["coupon"], case["country"], case["province"]
+        ),
+        "quote_items_scalar": forced_path(pricing._quote_items_scalar),
+        "calculate_price_based_on_discount": legacy_line_calls,
+        "Discount.line_discount": engine_line_calls,
+    }
+    if pricing.np is not None:
+        found["quote_items_vectorized"] = forced_path(pricing._quote_items_vectorized)
+    endpoint = validate_coupon_endpoint()
+    if endpoint is not None:
+        found["validate_coupon_endpoint"] = endpoint
+    return found
+
+
+def measure(fn, case, budget):
+    """Per-cart wall time over repeated runs (about ``budget`` seconds), then
+    one traced run for the peak memory allocated while pricing the cart."""
+    fn(case)  # warm up
+    timings = []
+    started = time.perf_counter()
+    while len(timings) < 5 or (time.perf_counter() - started < budget and len(timings) < 2000):
+        t0 = time.perf_counter()
+        fn(case)
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    fn(case)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    return {
+        "runs": len(timings),
+        "median_us": round(statistics.median(timings) * 1e6, 2),
+        "p95_us": round(timings[int(len(timings) * 0.95) - 1 if len(timings) > 1 else 0] * 1e6, 2),
+        "peak_alloc_bytes": peak,
+    }
+
+
+def run_suite(corpus, budget):
+    results = []
+    for target, fn in targets().items():
+        for case in corpus:
+            result = {
+                "target": target,
+                "case": case["name"],
+                "lines": case["lines"],
+                "value_type": case["value_type"],
+                "capped": case["capped"],
+            }
+            result.update(measure(fn, case, budget))
+            results.append(result)
+            print(
+                f"{target:34} {case['name']:32} median {result['median_us']:>10.1f}us "
+                f"p95 {result['p95_us']:>10.1f}us  peak {result['peak_alloc_bytes'] / 1024:>8.1f}KiB"
+            )
+    return results
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r["target"], r["case"]): r for r in json.load(f)["results"]}
+    print(f"\nmedian vs {baseline_path}:")
+    for result in results:
+        before = baseline.get((result["target"], result["case"]))
+        if before and before["median_us"]:
+            print(
+                f"{result['target']:34} {result['case']:32} "
+                f"{result['median_us'] / before['median_us']:6.2f}x"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="replay real (anonymized) carts from this JSON file instead of the synthetic built-in corpus")
+    parser.add_argument("--write-corpus", help="write the corpus used to this JSON file")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    parser.add_argument("--compare", help="results JSON from an earlier run to compare medians against")
+    parser.add_argument("--budget", type=float, default=0.2, help="seconds spent timing each target per cart")
+    args = parser.parse_args()
+
+    if args.corpus:
+        with open(args.corpus) as f:
+            corpus = json.load(f)
+    else:
+        corpus = build_corpus()
+    if args.write_corpus:
+        with open(args.write_corpus, "w") as f:
+            json.dump(corpus, f)
+
+    mismatches = check_sample_carts() + check_vectorized(corpus)
+    if mismatches:
+        raise SystemExit(f"{mismatches} cart(s) priced differently")
+    print("all carts price identically\n")
+
+    results = run_suite(corpus, args.budget)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "created_at": datetime.now(timezone.utc).isoformat(),
+                        "python": platform.python_version(),
+                        "numpy": pricing.np.__version__ if pricing.np is not None else None,
+                        "vectorize_min_lines": pricing.VECTORIZE_MIN_LINES,
+                        "platform": platform.platform(),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,361 @@
+"""Stock-check benchmark against a local Shopify stand-in. Runs offline.
+
+Starts a fake Shopify Admin API on localhost (variants, products,
+inventory_levels and locations endpoints) with configurable latency, 429
+injection and Retry-After, points the app at it, and runs
+check_stock_availability for carts of 1-50 items in each stock-check mode.
+Reports end-to-end time and upstream call counts per mode and cart size.
+
+    python bench_stock.py --latency-ms 80 --rate-429 0.05 --retry-after 1
+    python bench_stock.py --json results.json
+
+The app is pointed at a throwaway database (and rate-limit file) in a temp
+directory, so clearing the variant map and inventory mirror between runs
+never touches /tmp/orders.db.
+"""
+
+import argparse
+import atexit
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+CART_SIZES = (1, 5, 10, 25, 50)
+PRODUCTS = 60
+VARIANTS_PER_PRODUCT = 3
+LOCATIONS = (1, 2)
+
+
+# --- The fake store ---
+
+def build_catalogue(seed=1):
+    """variant id -> variant dict (with "available"), Shopify-shaped. Most
+    variants are tracked with a deny policy, like the real store."""
+    rng = random.Random(seed)
+    catalogue = {}
+    for p in range(1, PRODUCTS + 1):
+        for v in range(VARIANTS_PER_PRODUCT):
+            variant_id = p * 100 + v
+            kind = rng.random()
+            catalogue[variant_id] = {
+                "id": variant_id,
+                "product_id": p,
+                "inventory_item_id": variant_id * 10,
+                "inventory_management": None if kind < 0.1 else "shopify",
+                "inventory_policy": "continue" if 0.1 <= kind < 0.2 else "deny",
+                "updated_at": "2026-01-01T00:00:00+08:00",
+                "available": rng.randint(0, 20),
+            }
+    return catalogue
+
+
+class FakeShopify(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, catalogue, latency, rate_429, retry_after, seed=1):
+        super().__init__(("127.0.0.1", 0), FakeShopifyHandler)
+        self.catalogue = catalogue
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.reset_counts()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def reset_counts(self):
+        with self.lock:
+            self.calls = 0
+            self.throttled = 0
+
+    def throttle(self):
+        """Count the call; True if this one should get a 429."""
+        with self.lock:
+            self.calls += 1
+            if self.rng.random() < self.rate_429:
+                self.throttled += 1
+                return True
+            return False
+
+    def levels(self, inventory_item_ids=None):
+        levels = []
+        for variant in self.catalogue.values():
+            if inventory_item_ids is not None and variant["inventory_item_id"] not in inventory_item_ids:
+                continue
+            # Split each item's stock over the locations.
+            first = variant["available"] // 2
+            for location_id, available in zip(LOCATIONS, (first, variant["available"] - first)):
+                levels.append(
+                    {
+                        "inventory_item_id": variant["inventory_item_id"],
+                        "location_id": location_id,
+                        "available": available,
+                        "updated_at": variant["updated_at"],
+                    }
+                )
+        return levels
+
+
+class FakeShopifyHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        store = self.server
+        time.sleep(store.latency)
+        if store.throttle():
+            self.send_json(
+                429, {"errors": "Exceeded 2 calls per second"},
+                {"Retry-After": str(store.retry_after)},
+            )
+            return
+
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        def ids(name):
+            return [int(i) for i in query.get(name, [""])[0].split(",") if i]
+
+        match = re.search(r"/variants/(\d+)\.json$", url.path)
+        if match:
+            variant = store.catalogue.get(int(match.group(1)))
+            if variant is None:
+                self.send_json(404, {"errors": "Not Found"})
+            else:
+                self.send_json(200, {"variant": variant})
+        elif url.path.endswith("/products.json"):
+            wanted = set(ids("ids"))
+            products = {}
+            for variant in store.catalogue.values():
+                if variant["product_id"] in wanted:
+                    products.setdefault(
+                        variant["product_id"], {"id": variant["product_id"], "variants": []}
+                    )["variants"].append(variant)
+            self.send_json(200, {"products": list(products.values())})
+        elif url.path.endswith("/inventory_levels.json"):
+            if "inventory_item_ids" in query:
+                levels = store.levels(set(ids("inventory_item_ids")))
+            else:
+                levels = store.levels()
+            self.send_json(200, {"inventory_levels": levels})
+        elif url.path.endswith("/locations.json"):
+            self.send_json(200, {"locations": [{"id": i} for i in LOCATIONS]})
+        else:
+            self.send_json(404, {"errors": "Not Found"})
+
+
+# --- Carts ---
+
+def build_carts(catalogue, sizes=CART_SIZES, seed=1):
+    """One cart per size, each line a distinct variant spread over products."""
+    rng = random.Random(seed)
+    variant_ids = sorted(catalogue)
+    carts = {}
+    for size in sizes:
+        lines = []
+        for variant_id in rng.sample(variant_ids, size):
+            variant = catalogue[variant_id]
+            lines.append(
+                {
+                    "product_id": variant["product_id"],
+                    "variant_id": variant_id,
+                    "name": f"Variant {variant_id}",
+                    "quantity": rng.randint(1, 3),
+                }
+            )
+        carts[size] = lines
+    return carts
+
+
+# --- Modes ---
+
+def import_app(store, deadline_ms, client_rate):
+    os.environ["SHOPIFY_STORE_URL"] = store.url
+    os.environ.setdefault("SHOPIFY_API_KEY", "bench")
+    # reset() wipes the mirror tables; keep them away from the app's real data.
+    workdir = tempfile.mkdtemp(prefix="bench_stock_")
+    atexit.register(shutil.rmtree, workdir, ignore_errors=True)
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'orders.db')}"
+    os.environ["SHOPIFY_RATE_LIMIT_DB"] = os.path.join(workdir, "shopify_ratelimit.db")
+    import logging
+
+    import cache
+
+    # Importing app starts the first price rule sync in the background; its
+    # calls to the fake store would land in the counts, so skip it.
+    warm = cache.RefreshingIndex.warm
+    cache.RefreshingIndex.warm = lambda self: None
+    try:
+        import app as app_module
+    finally:
+        cache.RefreshingIndex.warm = warm
+    from ratelimit import TokenBucket
+
+    logging.disable(logging.CRITICAL)
+    app_module.SHOPIFY_STORE_URL = store.url
+    app_module.STOCK_CHECK_DEADLINE_MS = deadline_ms
+    # The mirror mode syncs explicitly; keep background syncs out of timings.
+    app_module.start_inventory_sync_if_due = lambda: None
+    if client_rate:
+        app_module.shopify_bucket = TokenBucket(rate=client_rate, capacity=40)
+    else:
+        app_module.shopify_bucket = TokenBucket(rate=1e9, capacity=1e9)
+    return app_module
+
+
+def reset(app_module, variant_map=True, stock_cache=True):
+    from models import InventoryLevel, Session, SyncState, VariantInventory
+
+    if stock_cache:
+        app_module.stock_cache.clear()
+    if variant_map:
+        db = Session()
+        try:
+            db.query(VariantInventory).delete()
+            db.commit()
+        finally:
+            db.close()
+        app_module.variant_map.invalidate()
+    db = Session()
+    try:
+        db.query(InventoryLevel).delete()
+        db.query(SyncState).filter_by(name="inventory_levels").delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+def modes(app_module):
+    """name -> (STOCK_CHECK_MODE, setup(cart) run before each timed check).
+    Setup calls aren't timed or counted."""
+
+    def cold(cart):
+        reset(app_module)
+
+    def warm_map(cart):
+        reset(app_module, variant_map=False)
+        app_module.stock_snapshot_batched(cart)  # learns the cart's variants
+
+    def warm_cache(cart):
+        app_module.stock_cache.clear()
+        app_module.check_stock_availability(cart)
+
+    def synced_mirror(cart):
+        reset(app_module, variant_map=False)
+        app_module.stock_snapshot_batched(cart)
+        app_module.sync_inventory_levels()
+
+    return {
+        "sequential": ("sequential", cold),
+        "concurrent": ("concurrent", cold),
+        "batched": ("batched", cold),
+        "batched+variant_map": ("batched", warm_map),
+        "cached": ("batched", warm_cache),
+        "mirror": ("mirror", synced_mirror),
+    }
+
+
+def run_suite(app_module, store, carts, runs, selected):
+    results = []
+    for name, (mode, setup) in modes(app_module).items():
+        if selected and name not in selected:
+            continue
+        app_module.STOCK_CHECK_MODE = mode
+        for size, cart in carts.items():
+            timings, calls, throttled = [], [], []
+            for _ in range(runs):
+                setup(cart)
+                store.reset_counts()
+                t0 = time.perf_counter()
+                app_module.check_stock_availability(cart)
+                timings.append(time.perf_counter() - t0)
+                calls.append(store.calls)
+                throttled.append(store.throttled)
+            result = {
+                "mode": name,
+                "items": size,
+                "runs": runs,
+                "median_ms": round(statistics.median(timings) * 1e3, 2),
+                "max_ms": round(max(timings) * 1e3, 2),
+                "upstream_calls": round(statistics.mean(calls), 2),
+                "throttled": round(statistics.mean(throttled), 2),
+            }
+            results.append(result)
+            print(
+                f"{name:20} {size:>3} items  median {result['median_ms']:>9.1f}ms "
+                f"max {result['max_ms']:>9.1f}ms  calls {result['upstream_calls']:>6.1f} "
+                f"429s {result['throttled']:>5.1f}"
+            )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency-ms", type=float, default=50, help="fake Shopify response latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of calls answered with a 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After seconds sent with each 429")
+    parser.add_argument("--client-rate", type=float, default=0, help="app-side Shopify rate limit in calls/second (0 = off)")
+    parser.add_argument("--deadline-ms", type=float, default=0, help="STOCK_CHECK_DEADLINE_MS for the run (0 = no limit)")
+    parser.add_argument("--runs", type=int, default=3, help="timed checks per mode and cart size")
+    parser.add_argument("--sizes", default=",".join(map(str, CART_SIZES)), help="comma-separated cart sizes")
+    parser.add_argument("--modes", help="comma-separated subset of modes to run")
+    parser.add_argument("--json", help="write machine-readable results to this file")
+    args = parser.parse_args()
+
+    catalogue = build_catalogue()
+    store = FakeShopify(catalogue, args.latency_ms / 1000, args.rate_429, args.retry_after)
+    threading.Thread(target=store.serve_forever, daemon=True).start()
+    try:
+        app_module = import_app(store, args.deadline_ms, args.client_rate)
+        carts = build_carts(catalogue, [int(s) for s in args.sizes.split(",")])
+        selected = set(args.modes.split(",")) if args.modes else None
+        results = run_suite(app_module, store, carts, args.runs, selected)
+    finally:
+        store.shutdown()
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "created_at": datetime.now(timezone.utc).isoformat(),
+                        "python": platform.python_version(),
+                        "platform": platform.platform(),
+                        "latency_ms": args.latency_ms,
+                        "rate_429": args.rate_429,
+                        "retry_after": args.retry_after,
+                        "client_rate": args.client_rate,
+                        "deadline_ms": args.deadline_ms,
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
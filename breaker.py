@@ -0,0 +1,171 @@
+# breaker.py
+
+import logging
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(Exception):
+    """A call was refused because its upstream's circuit is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} circuit is open, retry in {retry_after:.0f}s")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Per-process circuit breaker for one upstream.
+
+    - Closed: calls go through. Outcomes from the last ``window`` seconds are
+      kept; once there are at least ``min_calls`` of them and
+      ``failure_rate`` or more failed, the circuit opens. A call counts as
+      failed if it raised, its result matched ``is_failure``, or it took
+      longer than ``slow_call`` seconds.
+    - Open: calls fail fast with CircuitOpen for ``open_for`` seconds.
+    - Half-open: up to ``probes`` trial calls at a time are let through.
+      ``probes`` successes in a row close the circuit; any failure opens it
+      again.
+    """
+
+    def __init__(
+        self,
+        name,
+        failure_rate=0.5,
+        min_calls=10,
+        window=30,
+        slow_call=5.0,
+        open_for=30,
+        probes=3,
+    ):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call = slow_call
+        self.open_for = open_for
+        self.probes = probes
+        self.rejected = 0
+        self._state = CLOSED
+        self._outcomes = deque()  # (time.monotonic(), failed) while closed
+        self._opened_at = None
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            return self._state
+
+    def check(self):
+        """Raise CircuitOpen if a call made now would be refused. Doesn't
+        take a half-open trial slot; use it to fail fast before doing work
+        that leads up to a call."""
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == OPEN or (
+                self._state == HALF_OPEN and self._probes_in_flight >= self.probes
+            ):
+                raise self._refuse()
+
+    def call(self, fn, *args, is_failure=None, ignore_error=None, **kwargs):
+        """Run ``fn(*args, **kwargs)`` through the breaker and return its
+        result. Raises CircuitOpen without calling it while open. Exceptions
+        matching ``ignore_error`` (not the upstream's fault, e.g. the caller's
+        own deadline) are passed on without counting either way."""
+        probe = self._admit()
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if ignore_error is not None and ignore_error(e):
+                self._record(probe, failed=None)
+            else:
+                self._record(probe, failed=True)
+            raise
+        failed = time.monotonic() - started > self.slow_call or bool(
+            is_failure and is_failure(result)
+        )
+        self._record(probe, failed)
+        return result
+
+    def stats(self):
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            failures = sum(failed for _, failed in self._outcomes)
+            return {
+                "state": self._state,
+                "calls": len(self._outcomes),
+                "failures": failures,
+                "rejected": self.rejected,
+            }
+
+    def _admit(self):
+        """Let one call through, or raise CircuitOpen. True if it's a
+        half-open trial."""
+        with self._lock:
+            self._maybe_half_open(time.monotonic())
+            if self._state == CLOSED:
+                return False
+            if self._state == HALF_OPEN and self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return True
+            raise self._refuse()
+
+    def _record(self, probe, failed):
+        """Count one outcome; ``failed`` None only frees the trial slot."""
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probes_in_flight = max(self._probes_in_flight - 1, 0)
+                if failed is None or self._state != HALF_OPEN:
+                    return  # another trial already settled it
+                if failed:
+                    self._open(now, "a trial call failed")
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.probes:
+                        self._close()
+                return
+
+            if failed is None or self._state != CLOSED:
+                return  # ignored, or started before the circuit opened
+            self._outcomes.append((now, failed))
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._outcomes.popleft()
+            calls = len(self._outcomes)
+            failures = sum(f for _, f in self._outcomes)
+            if calls >= self.min_calls and failures / calls >= self.failure_rate:
+                self._open(now, f"{failures}/{calls} calls failed in {self.window}s")
+
+    def _maybe_half_open(self, now):
+        if self._state == OPEN and now - self._opened_at >= self.open_for:
+            self._state = HALF_OPEN
+            self._probes_in_flight = 0
+            self._probe_successes = 0
+            logging.info(f"{self.name} circuit half-open, sending trial calls")
+
+    def _open(self, now, reason):
+        self._state = OPEN
+        self._opened_at = now
+        self._outcomes.clear()
+        logging.error(f"{self.name} circuit opened ({reason}); failing fast for {self.open_for}s")
+
+    def _close(self):
+        self._state = CLOSED
+        self._outcomes.clear()
+        logging.warning(f"{self.name} circuit closed, {self.probes} trial calls succeeded")
+
+    def _refuse(self):
+        self.rejected += 1
+        retry_after = 1.0  # half-open: the trial calls settle it shortly
+        if self._state == OPEN:
+            retry_after = max(self._opened_at + self.open_for - time.monotonic(), 0.0)
+        return CircuitOpen(self.name, retry_after)
@@ -0,0 +1,259 @@
+# cache.py
+
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+
+class LoadFailed(Exception):
+    """A RefreshingIndex has never loaded and its loader is failing."""
+
+
+class RefreshingIndex:
+    """Shared in-process key -> value map rebuilt as a whole by ``loader``.
+
+    - Fresh (younger than ``ttl``): served straight from memory.
+    - Stale (within ``stale_ttl`` after that): still served, while one
+      background thread reloads it (stale-while-revalidate).
+    - Expired or never loaded: callers block on the reload, for at most the
+      ``timeout`` they pass (the reload carries on in the background).
+    - Never loaded and the reload failed: LoadFailed, rather than an empty
+      map that callers would take for "no entries".
+
+    Reloads are single-flight: however many threads ask at once, ``loader``
+    runs at most once and everyone else waits for (or skips) that result.
+    ``ttl <= 0`` means the data never expires on its own. ``on_change`` is
+    called (with no arguments) whenever the contents actually change.
+    """
+
+    def __init__(
+        self, loader, ttl, stale_ttl=0, error_backoff=5, name="index", on_change=None
+    ):
+        self._loader = loader
+        self._on_change = on_change
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.error_backoff = error_backoff
+        self.name = name
+        self._data = None
+        self._loaded_at = float("-inf")
+        self._failed_at = None
+        self._lock = threading.Lock()
+        self._inflight = None  # threading.Event while a reload is running
+
+    def get(self, key, default=None, timeout=None):
+        return self.snapshot(timeout).get(key, default)
+
+    def snapshot(self, timeout=None):
+        """Return the current mapping, reloading it first if needed. Raises
+        TimeoutError if a blocking reload takes longer than ``timeout``
+        seconds (None = wait however long it takes), and LoadFailed if it has
+        never loaded and the reload failed (or is backing off from failing)."""
+        data = self._data
+        age = time.monotonic() - self._loaded_at
+
+        ttl = self.ttl if self.ttl > 0 else float("inf")
+        if data is not None and age < ttl:
+            return data
+        if self._backing_off():
+            if data is None:
+                raise LoadFailed(f"{self.name}: not loaded, backing off after a failed reload")
+            return data
+        if data is not None and age < ttl + self.stale_ttl:
+            self._refresh(wait=False)
+            return data
+
+        self._refresh(wait=True, timeout=timeout)
+        data = self._data
+        if data is None:
+            raise LoadFailed(f"{self.name}: not loaded, the reload failed")
+        return data
+
+    def warm(self):
+        """Start loading in the background, so the first caller needn't wait."""
+        if self._data is None:
+            self._refresh(wait=False)
+
+    def put(self, key, value):
+        """Insert or replace one entry without a reload (no-op until loaded)."""
+        with self._lock:
+            if self._data is None:
+                return
+            # Copy-on-write: readers keep using the dict they already hold.
+            self._data = {**self._data, key: value}
+        self._changed()
+
+    def evict_where(self, predicate):
+        """Drop every entry whose (key, value) matches; returns how many."""
+        with self._lock:
+            if self._data is None:
+                return 0
+            kept = {k: v for k, v in self._data.items() if not predicate(k, v)}
+            evicted = len(self._data) - len(kept)
+            self._data = kept
+        if evicted:
+            self._changed()
+        return evicted
+
+    def invalidate(self):
+        """Force the next read to reload (blocking)."""
+        with self._lock:
+            self._loaded_at = float("-inf")
+            self._failed_at = None
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def _backing_off(self):
+        failed_at = self._failed_at
+        return (
+            failed_at is not None
+            and time.monotonic() - failed_at < self.error_backoff
+        )
+
+    def _refresh(self, wait, timeout=None):
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                event = self._inflight = threading.Event()
+
+        if leader and wait and timeout is None:
+            self._run(event)
+            return
+        if leader:
+            threading.Thread(
+                target=self._run, args=(event,), daemon=True,
+                name=f"{self.name}-refresh",
+            ).start()
+        if wait and not event.wait(timeout):
+            raise TimeoutError(f"{self.name}: reload still running after {timeout:.2f}s")
+
+    def _run(self, event):
+        started = time.monotonic()
+        try:
+            # The reload serves every caller, so it runs outside the context
+            # (and any deadline) of whichever one happened to trigger it.
+            data = contextvars.Context().run(self._loader)
+            with self._lock:
+                changed = data != self._data
+                self._data = data
+                self._loaded_at = time.monotonic()
+                self._failed_at = None
+            if changed:
+                self._changed()
+            logging.info(
+                f"{self.name}: loaded {len(data)} entries in "
+                f"{time.monotonic() - started:.3f}s"
+            )
+        except Exception as e:
+            # Keep serving whatever we had; don't hammer upstream while it's down.
+            logging.error(f"{self.name}: reload failed, keeping previous data: {e}")
+            with self._lock:
+                self._failed_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
+
+
+class TTLCache:
+    """Bounded, thread-safe LRU map whose entries expire ``ttl`` seconds after
+    they were set. Counts hits and misses."""
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def evict_where(self, predicate):
+        """Drop every entry whose (key, value) matches; returns how many."""
+        with self._lock:
+            doomed = [k for k, (_, v) in self._data.items() if predicate(k, v)]
+            for key in doomed:
+                del self._data[key]
+        return len(doomed)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+        }
+
+
+class SingleFlight:
+    """Coalesces concurrent loads of the same keys: the first caller to claim a
+    key loads it, and everyone else asking meanwhile waits for that result
+    instead of loading it again. Keys can be claimed and resolved in batches.
+    """
+
+    def __init__(self):
+        self.coalesced = 0  # waits served by another caller's load
+        self._inflight = {}  # key -> Future
+        self._lock = threading.Lock()
+
+    def claim(self, keys):
+        """Split ``keys`` into (keys the caller must load and then resolve,
+        {key: Future} for keys someone else is already loading)."""
+        mine, theirs = [], {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                future = self._inflight.get(key)
+                if future is None:
+                    self._inflight[key] = Future()
+                    mine.append(key)
+                else:
+                    theirs[key] = future
+            self.coalesced += len(theirs)
+        return mine, theirs
+
+    def resolve(self, key, value):
+        """Hand a claimed key's result to its waiters. Always call this for
+        every claimed key, even when the load failed."""
+        with self._lock:
+            future = self._inflight.pop(key, None)
+        if future is not None:
+            future.set_result(value)
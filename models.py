@@ -1,11 +1,13 @@
 # models.py
 
-from sqlalchemy import create_engine, Column, Integer, String
+import os
+
+from sqlalchemy import create_engine, Column, Float, Integer, String, Text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-# Define the database engine
-engine = create_engine('sqlite:////tmp/orders.db', echo=True)  # Save the database in the writable /tmp directory  # This will create a SQLite database file called 'orders.db'
+# Define the database engine (DATABASE_URL points a benchmark or second copy at its own database)
+engine = create_engine(os.getenv("DATABASE_URL", 'sqlite:////tmp/orders.db'), echo=True)  # Save the database in the writable /tmp directory  # This will create a SQLite database file called 'orders.db'
 
 # Create a base class for the models
 Base = declarative_base()
@@ -30,7 +32,76 @@ class ProcessedPurchase(Base):
 
     chip_in_id = Column(String, primary_key=True)
     shopify_order_id = Column(String)
-    status = Column(String)  # "processing" | "done"
+    # "processing" (claimed) | "ordering" (order POST sent: never released,
+    # a retry could create a second order) | "done"
+    status = Column(String)
+
+
+# Local mirror of Shopify price rules, so coupon validation is a local lookup.
+# Filled by sync_price_rules() in app.py: one paginated full sync, then
+# updated_at_min deltas.
+class PriceRule(Base):
+    __tablename__ = 'price_rules'
+
+    id = Column(String, primary_key=True)  # Shopify price rule id
+    title = Column(String, index=True)  # the code customers type
+    value = Column(String)  # e.g. "-10.0"
+    value_type = Column(String)  # "percentage" | "fixed_amount"
+    updated_at = Column(String)  # Shopify ISO timestamp, used as the delta cursor
+    data = Column(Text)  # full rule JSON as returned by Shopify
+
+
+# What the stock check needs to know about a variant, which almost never
+# changes: where its stock lives and whether it can run out. Filled as stock
+# checks see variants and kept current by products/* webhooks (app.py).
+class VariantInventory(Base):
+    __tablename__ = 'variant_inventory'
+
+    variant_id = Column(String, primary_key=True)  # Shopify variant id
+    product_id = Column(String, index=True)
+    inventory_item_id = Column(String)
+    inventory_management = Column(String)  # None/"" = untracked
+    inventory_policy = Column(String)  # "deny" | "continue"
+    updated_at = Column(String)  # Shopify ISO timestamp of the variant
+
+
+# Local mirror of Shopify inventory levels (one row per item per location),
+# so stock checks don't wait on Shopify. Seeded by sync_inventory_levels() in
+# app.py and kept current by inventory_levels/update webhooks.
+class InventoryLevel(Base):
+    __tablename__ = 'inventory_levels'
+
+    inventory_item_id = Column(String, primary_key=True)
+    location_id = Column(String, primary_key=True)
+    available = Column(Integer)
+    updated_at = Column(String)  # Shopify ISO timestamp of this level
+    synced_at = Column(Float)  # unix time we last confirmed it (sync or webhook)
+
+
+# Soft stock holds between checkout creation and payment, so concurrent
+# checkouts for the last units are arbitrated here rather than by Shopify at
+# order time. A hold counts against stock while status is "held" and it
+# hasn't expired; the paid webhook consumes it, a failed payment releases it.
+class StockReservation(Base):
+    __tablename__ = 'stock_reservations'
+
+    id = Column(Integer, primary_key=True)
+    reservation_id = Column(String, index=True)  # one per checkout, sent in Chip In metadata
+    variant_id = Column(String, index=True)
+    quantity = Column(Integer)
+    status = Column(String)  # "held" | "consumed" | "released"
+    created_at = Column(Float)
+    expires_at = Column(Float)
+
+
+# Bookkeeping for background sync jobs, shared by every worker.
+class SyncState(Base):
+    __tablename__ = 'sync_state'
+
+    name = Column(String, primary_key=True)  # e.g. "price_rules"
+    cursor = Column(String)  # newest updated_at seen so far
+    last_synced_at = Column(Float)  # unix time of the last successful delta
+    last_full_sync_at = Column(Float)  # unix time of the last full sync
 
 # Create the table
 Base.metadata.create_all(engine)
@@ -0,0 +1,318 @@
+# pricing.py
+#
+# Cart pricing shared by checkout, coupon validation and quotes. Every amount
+# is integer sen (Shopify cart prices are already in cents), so totals never
+# pick up float noise.
+
+from dataclasses import dataclass, field
+from decimal import Decimal, ROUND_HALF_UP
+from functools import cached_property, total_ordering
+
+try:
+    import numpy as np
+except ImportError:  # the scalar path prices everything without it
+    np = None
+
+DISCOUNT_CAP_SEN = 2000  # 2000 sen = 20 ringgit of coupon discount per order
+
+# Flat shipping per destination, in sen. Sabah, Sarawak and Labuan
+# (MY-12, MY-13, MY-15) cost more than Peninsular Malaysia.
+MY_EAST_PROVINCES = ("MY-12", "MY-13", "MY-15")
+MY_EAST_SHIPPING_SEN = 900
+MY_WEST_SHIPPING_SEN = 700
+INTERNATIONAL_SHIPPING_SEN = {"SG": 4000, "BN": 7000, "ID": 11000}
+
+# Carts with at least this many lines (team and academy orders) are priced
+# with NumPy when it's installed; below that the per-line loop is faster.
+VECTORIZE_MIN_LINES = 32
+
+
+class PriceMismatch(ValueError):
+    """A cart line's amounts don't add up."""
+
+
+@total_ordering
+class Money:
+    """An amount of MYR, held as integer sen."""
+
+    __slots__ = ("sen",)
+
+    def __init__(self, sen=0):
+        self.sen = int(sen)
+
+    @classmethod
+    def from_sen(cls, value):
+        """From a sen amount as Shopify sends it (int, float or string),
+        rounded half-up to a whole sen."""
+        if isinstance(value, int):
+            return cls(value)
+        if isinstance(value, float) and value.is_integer():
+            return cls(int(value))
+        return cls(Decimal(str(value)).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+    def ringgit(self):
+        """Two-decimal ringgit string, as Shopify's Admin API expects."""
+        sign = "-" if self.sen < 0 else ""
+        whole, cents = divmod(abs(self.sen), 100)
+        return f"{sign}{whole}.{cents:02d}"
+
+    def __add__(self, other):
+        return Money(self.sen + other.sen)
+
+    def __sub__(self, other):
+        return Money(self.sen - other.sen)
+
+    def __neg__(self):
+        return Money(-self.sen)
+
+    def __eq__(self, other):
+        return isinstance(other, Money) and self.sen == other.sen
+
+    def __lt__(self, other):
+        return self.sen < other.sen
+
+    def __hash__(self):
+        return hash(self.sen)
+
+    def __bool__(self):
+        return self.sen != 0
+
+    def __int__(self):
+        return self.sen
+
+    def __repr__(self):
+        return f"Money({self.sen})"
+
+    def __str__(self):
+        return self.ringgit()
+
+
+ZERO = Money(0)
+
+
+@dataclass(frozen=True)
+class Discount:
+    """A coupon as a Shopify price rule describes it. ``value`` is Shopify's
+    signed amount: -10.0 is 10% off or 10 ringgit off."""
+
+    code: str
+    value: Decimal
+    value_type: str  # "percentage" | "fixed_amount"
+
+    @classmethod
+    def from_rule(cls, code, value, value_type):
+        return cls(code, Decimal(str(value)), value_type)
+
+    @cached_property
+    def rate(self):
+        """Share of the line taken off, as an exact (numerator, denominator)
+        pair (percentage rules only)."""
+        numerator, denominator = (-self.value).as_integer_ratio()
+        return numerator, denominator * 100
+
+    @cached_property
+    def fixed_sen(self):
+        """Sen taken off each line (fixed_amount rules only)."""
+        numerator, denominator = (-self.value * 100).as_integer_ratio()
+        return round_half_up(numerator, denominator)
+
+    def line_discount(self, line):
+        """Discount on one line before the order cap; never more than the line.
+        Percentages round half-up to the sen. Fixed amounts apply per line."""
+        return Money(self.line_discount_sen(line.sen))
+
+    def line_discount_sen(self, sen):
+        if self.value_type == "percentage":
+            numerator, denominator = self.rate
+            amount = round_half_up(sen * numerator, denominator)
+        elif self.value_type == "fixed_amount":
+            amount = self.fixed_sen
+        else:
+            amount = 0
+        return min(max(amount, 0), sen)
+
+
+def round_half_up(numerator, denominator):
+    """Nearest integer to numerator / denominator (denominator > 0), halves
+    rounded up."""
+    return (2 * numerator + denominator) // (2 * denominator)
+
+
+@dataclass
+class LineQuote:
+    amount: Money  # what the line costs before the coupon
+    discount: Money  # coupon discount actually given on this line
+
+    @property
+    def price(self):
+        return self.amount - self.discount
+
+
+@dataclass
+class Quote:
+    lines: list = field(default_factory=list)
+    subtotal: Money = ZERO
+    discount: Money = ZERO
+    shipping: Money = ZERO
+    cap_applied: bool = False  # the order cap cut the coupon short
+
+    @property
+    def total(self):
+        return self.subtotal - self.discount + self.shipping
+
+    def as_dict(self):
+        return {
+            "subtotal": self.subtotal.sen,
+            "discount": self.discount.sen,
+            "shipping": self.shipping.sen,
+            "total": self.total.sen,
+            "cap_applied": self.cap_applied,
+        }
+
+
+def shipping_fee(country, province, requires_shipping=True):
+    """Flat shipping for a destination, as Money."""
+    if not requires_shipping:
+        return ZERO
+    if country == "MY":
+        if province in MY_EAST_PROVINCES:
+            return Money(MY_EAST_SHIPPING_SEN)
+        return Money(MY_WEST_SHIPPING_SEN)
+    return Money(INTERNATIONAL_SHIPPING_SEN.get(country, 0))
+
+
+def check_line(item):
+    """The checkout's consistency checks on one cart line (float math, as
+    the storefront computes it). Raises PriceMismatch."""
+    # validate: original_price * quantity = original_line_price
+    # recheck this
+    if round(float(item["original_price"]), 2) != round(
+        float(item["original_price"]) * float(item["quantity"]), 2
+    ):
+        raise PriceMismatch("Item price mismatch this")
+
+    # validate: final_line_price = original_line_price - total_discount
+    if round(float(item["final_line_price"]), 2) != round(
+        float(item["original_line_price"]) - float(item["total_discount"]), 2
+    ):
+        raise PriceMismatch("Item price mismatch that")
+
+
+def line_amount(item, basis="final"):
+    """What a cart line costs before the coupon.
+
+    ``basis="final"``: final_line_price, i.e. after automatic discounts. This is
+    what checkout charges. ``basis="unit"``: price x quantity, used by the
+    coupon preview."""
+    if basis == "unit":
+        return Money.from_sen(Decimal(str(item["price"])) * Decimal(str(item["quantity"])))
+    return Money.from_sen(item["final_line_price"])
+
+
+def quote_items(
+    items,
+    discount=None,
+    country=None,
+    province=None,
+    basis="final",
+    validate=False,
+    cap=DISCOUNT_CAP_SEN,
+):
+    """Price a cart in one pass: line checks (``validate``), each line's
+    discounted price, consumption of the order-wide coupon cap, and shipping.
+    Returns a Quote."""
+    if np is not None and len(items) >= VECTORIZE_MIN_LINES:
+        return _quote_items_vectorized(
+            items, discount, country, province, basis, validate, cap
+        )
+    return _quote_items_scalar(items, discount, country, province, basis, validate, cap)
+
+
+def _quote_items_scalar(items, discount, country, province, basis, validate, cap):
+    quote = Quote()
+    cap_left = cap
+    subtotal = discount_total = 0
+    requires_shipping = False
+
+    for item in items:
+        if validate:
+            check_line(item)
+        amount = line_amount(item, basis).sen
+
+        line_discount = 0
+        if discount is not None and amount:
+            line_discount = discount.line_discount_sen(amount)
+            if line_discount > cap_left:
+                line_discount = cap_left
+                quote.cap_applied = True
+            cap_left -= line_discount
+
+        quote.lines.append(LineQuote(Money(amount), Money(line_discount)))
+        subtotal += amount
+        discount_total += line_discount
+        requires_shipping = requires_shipping or bool(item.get("requires_shipping", True))
+
+    quote.subtotal = Money(subtotal)
+    quote.discount = Money(discount_total)
+    quote.shipping = shipping_fee(country, province, requires_shipping)
+    return quote
+
+
+def _column(items, key):
+    return np.array([float(item[key]) for item in items], dtype=np.float64)
+
+
+def _to_sen(amounts):
+    # Round half-up to whole sen, like Money.from_sen.
+    return np.floor(amounts + 0.5).astype(np.int64)
+
+
+def _quote_items_vectorized(items, discount, country, province, basis, validate, cap):
+    """Same result as _quote_items_scalar, computed column-wise."""
+    if validate:
+        original_price = _column(items, "original_price")
+        bad_this = np.round(original_price, 2) != np.round(
+            original_price * _column(items, "quantity"), 2
+        )
+        bad_that = np.round(_column(items, "final_line_price"), 2) != np.round(
+            _column(items, "original_line_price") - _column(items, "total_discount"), 2
+        )
+        bad = bad_this | bad_that
+        if bad.any():
+            # Report the first bad line, as the per-line loop would.
+            first = int(np.argmax(bad))
+            raise PriceMismatch(
+                "Item price mismatch this" if bad_this[first] else "Item price mismatch that"
+            )
+
+    if basis == "unit":
+        amounts = _to_sen(_column(items, "price") * _column(items, "quantity"))
+    else:
+        amounts = _to_sen(_column(items, "final_line_price"))
+
+    quote = Quote()
+    if discount is not None and discount.value_type in ("percentage", "fixed_amount"):
+        if discount.value_type == "percentage":
+            numerator, denominator = discount.rate
+            wanted = (2 * amounts * numerator + denominator) // (2 * denominator)
+        else:
+            wanted = np.full(len(amounts), discount.fixed_sen, dtype=np.int64)
+        wanted = np.clip(wanted, 0, amounts)
+
+        # Running total of what the cap allows: each line gets what's left of
+        # the cap after every earlier line's discount.
+        allowed_so_far = np.minimum(np.cumsum(wanted), cap)
+        given = np.diff(allowed_so_far, prepend=0)
+        quote.cap_applied = bool((given < wanted).any())
+    else:
+        given = np.zeros(len(amounts), dtype=np.int64)
+
+    quote.lines = [
+        LineQuote(Money(amount), Money(line_discount))
+        for amount, line_discount in zip(amounts.tolist(), given.tolist())
+    ]
+    quote.subtotal = Money(int(amounts.sum()))
+    quote.discount = Money(int(given.sum()))
+    requires_shipping = any(bool(item.get("requires_shipping", True)) for item in items)
+    quote.shipping = shipping_fee(country, province, requires_shipping)
+    return quote
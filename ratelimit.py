@@ -0,0 +1,185 @@
+# ratelimit.py
+
+import logging
+import sqlite3
+import threading
+import time
+
+from cache import TTLCache
+
+
+class TokenBucket:
+    """In-process token bucket: holds up to ``capacity`` tokens and refills at
+    ``rate`` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._last_available = float(capacity)  # as of the last update
+        self._lock = threading.Lock()
+
+    def _update(self, change):
+        """Refill up to now, then atomically replace the token count with
+        ``change(available)`` -> (new count, result). Returns result."""
+        with self._lock:
+            now = time.monotonic()
+            available = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._tokens, result = change(available)
+            self._updated = now
+            self._last_available = self._tokens
+            return result
+
+    def try_acquire(self, tokens=1, reserve=0):
+        """Take ``tokens`` if that leaves at least ``reserve`` in the bucket
+        (kept for higher-priority callers). Returns (acquired, seconds until
+        they would be available)."""
+
+        def take(available):
+            if available - tokens >= reserve:
+                return available - tokens, (True, 0.0)
+            return available, (False, (tokens + reserve - available) / self.rate)
+
+        return self._update(take)
+
+    def acquire(self, tokens=1, block=True, timeout=None, reserve=0):
+        """Take ``tokens``, sleeping until they're available when ``block`` is
+        set (up to ``timeout`` seconds). Returns whether they were taken."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            acquired, wait = self.try_acquire(tokens, reserve)
+            if acquired:
+                return True
+            if not block:
+                return False
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining < wait:
+                    return False
+            time.sleep(wait)
+
+    def observe(self, used, size):
+        """Sync with the fill level the server reports (``used`` of ``size``):
+        never assume more tokens than it says are left. Adopts ``size`` as
+        the capacity if it differs (e.g. a plan with a bigger bucket)."""
+        if size != self.capacity:
+            logging.info(f"token bucket capacity {self.capacity} -> {size} (from server)")
+            self.capacity = size
+        self._update(lambda available: (min(available, size - used), None))
+
+    def fill_level(self):
+        """Share of the bucket in use as of the last update: 0.0 empty, 1.0 full."""
+        return max(0.0, min(1.0, 1 - self._last_available / self.capacity))
+
+    def pacing_delay(self, threshold):
+        """Seconds to pause before the next call so usage eases off as the
+        bucket fills: nothing up to ``threshold`` (a fill level), rising
+        linearly to one refill interval (1 / rate) when full."""
+        level = self.fill_level()
+        if level <= threshold:
+            return 0.0
+        return min(1.0, (level - threshold) / (1 - threshold)) / self.rate
+
+
+class RateLimited(Exception):
+    """No token was available and the caller asked not to wait."""
+
+
+class SharedTokenBucket(TokenBucket):
+    """TokenBucket whose state lives in a SQLite file, so every process that
+    opens the same ``path`` and ``name`` (e.g. all gunicorn workers) draws
+    from one bucket. Each update is a BEGIN IMMEDIATE read-modify-write of one
+    row. If the file can't be used, falls back to pacing this process alone.
+    """
+
+    def __init__(self, path, rate, capacity, name="default", busy_timeout=5.0):
+        super().__init__(rate, capacity)
+        self.path = path
+        self.name = name
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()  # sqlite3 connections are per thread
+        self._table_ready = False
+        try:
+            self._create_table()
+        except sqlite3.Error as e:
+            # Don't take the app down with it; _update retries the setup.
+            logging.error(f"shared token bucket {self.name} unavailable, pacing locally: {e}")
+
+    def _create_table(self):
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS token_buckets "
+            "(name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._table_ready = True
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                self.path, timeout=self.busy_timeout, isolation_level=None
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, change):
+        try:
+            if not self._table_ready:
+                self._create_table()
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            logging.error(f"shared token bucket {self.name} unavailable, pacing locally: {e}")
+            return super()._update(change)
+
+        try:
+            row = conn.execute(
+                "SELECT tokens, updated_at FROM token_buckets WHERE name = ?",
+                (self.name,),
+            ).fetchone()
+            # Wall-clock time: monotonic clocks aren't comparable across processes.
+            now = time.time()
+            if row is None:
+                available = float(self.capacity)
+            else:
+                refill = max(0.0, now - row[1]) * self.rate
+                available = min(self.capacity, row[0] + refill)
+
+            tokens, result = change(available)
+            conn.execute(
+                "INSERT INTO token_buckets (name, tokens, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET "
+                "tokens = excluded.tokens, updated_at = excluded.updated_at",
+                (self.name, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            conn.execute("ROLLBACK")
+            logging.error(f"shared token bucket {self.name} failed, pacing locally: {e}")
+            return super()._update(change)
+        self._last_available = tokens
+        return result
+
+
+class KeyedRateLimiter:
+    """One TokenBucket per client key (IP address, session, ...). Idle buckets
+    are forgotten once they would have refilled anyway, and at most
+    ``max_keys`` are tracked."""
+
+    def __init__(self, rate, capacity, max_keys=10000):
+        self.rate = rate
+        self.capacity = capacity
+        self._buckets = TTLCache(maxsize=max_keys, ttl=capacity / rate)
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key, tokens=1):
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.capacity)
+            # Touch on every call so an active client's bucket is kept.
+            self._buckets.set(key, bucket)
+        return bucket.try_acquire(tokens)
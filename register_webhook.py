@@ -13,7 +13,7 @@ headers = {
 payload = {
     "title": "Chip In Webhook",
     "public_key": "-----BEGIN PUBLIC KEY-----\nMIIBojANBgkqhkiG9w0BAQEFAAOCAY8AMIIBigKCAYEAuyGnHmDXWx/tKuQjwNiE\nldsgwMA4yFUcy4W6LEUqvEFf+/CwvFhrheWi6yRECoVdwP6Jb2OBPEcMb05d1jsK\nhk/PHuwL4j4wWX2uqamok8ZypZyiJTtwN7VtfvXUYJQ5yitoUNS1rj2a6D15gClX\ngaNAqV4sPXwJSnZzFVWbawa23eze7dcoxyVPHmMlEcN3Gsfs7iCEYh2KW5u5Y3dz\n46+BJu4ciDBI21Lj0rR3E1PT/D6teOg8zyXbsupkLMjkNt1ngYpxD/+86lJ/OWuL\n8J8vmrIDFILv+xpyMg2YwMzGOALG2syy4L79mchS4RVWzZG/3sLn212Rs5bvWIGZ\nyG8uMB+Qk7ySfLGpa/6K5VS/J14gAqylA49bDBwvu6AuaR5YMhhsq4htZuN8kphf\nnLlECbAuUCGUh0Ngj8fs46dYIM1xD4rGQiVnSZKcriLDK5tOfux+NASS7/sKooIP\nRDcBw1bdVctacoQDE5ic1AlY8cIvsT0enUQt+k6ee2Y5AgMBAAE=\n-----END PUBLIC KEY-----\n",  # Replace with your actual public key
-    "events": ["purchase.paid"],
+    "events": ["purchase.paid", "purchase.payment_failure", "purchase.cancelled"],
     "callback": "https://chip-in-backend-4531.onrender.com/chipin-webhook",  # Replace with your actual backend URL
 }
 